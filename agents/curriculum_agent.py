@@ -1,12 +1,17 @@
 import json
 import boto3
 import os
+import asyncio
+import hashlib
+from contextvars import ContextVar
+from functools import lru_cache
 from typing import Optional
+from botocore.config import Config
 from strands import Agent, tool
 from strands.models import BedrockModel
-import sys
-sys.path.append('..')
 from chat_context import build_message_with_context
+from agents.utils.cache_utils import SemanticCache
+from agents.utils.stream_utils import strip_thinking
 import logging
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -16,35 +21,87 @@ BEDROCK_REGION = os.getenv("BEDROCK_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("ACCESS_KEY")
 AWS_SECRET_ACCESS_KEY = os.getenv("SECRET_KEY")
 KNOWLEDGE_BASE_ID = os.getenv("KB_ID")
+KB_MIN_SCORE = float(os.getenv("KB_MIN_SCORE", 0.5))
+
+# Semantic cache for KB retrievals (opt-in)
+KB_CACHE_ENABLED = os.getenv("KB_CACHE_ENABLED", "false").lower() == "true"
+KB_EMBED_MODEL_ID = os.getenv("KB_EMBED_MODEL_ID", "amazon.titan-embed-text-v2:0")
 
 CONFIG_PATH = "agents/config/curriculum_config.json"
-with open(CONFIG_PATH, "r") as f:
-    config = json.load(f)
+
+@lru_cache(maxsize=1)
+def _load_config() -> dict:
+    """Read the agent configuration on first use"""
+    with open(CONFIG_PATH, "r") as f:
+        return json.load(f)
+
+# AWS clients (reused across invocations to keep connections warm)
+client_config = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+)
+bedrock_agent_client = boto3.client(
+    "bedrock-agent-runtime",
+    region_name=BEDROCK_REGION,
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
+)
+bedrock_runtime_client = boto3.client(
+    "bedrock-runtime",
+    region_name=BEDROCK_REGION,
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
+)
+
+def _embed_query(text: str) -> list[float]:
+    """Embed text with Bedrock Titan Embeddings"""
+    response = bedrock_runtime_client.invoke_model(
+        modelId=KB_EMBED_MODEL_ID,
+        contentType="application/json",
+        accept="application/json",
+        body=json.dumps({"inputText": text})
+    )
+    return json.loads(response["body"].read())["embedding"]
+
+kb_cache = SemanticCache(
+    embed_fn=_embed_query,
+    threshold=float(os.getenv("KB_CACHE_THRESHOLD", 0.9)),
+    ttl_seconds=float(os.getenv("KB_CACHE_TTL", 3600)),
+    max_entries=int(os.getenv("KB_CACHE_MAX_ENTRIES", 256)),
+    max_scan=int(os.getenv("KB_CACHE_MAX_SCAN", 32)),
+) if KB_CACHE_ENABLED else None
+
+# Session whose retrievals may share cache entries; set by the handler per request.
+# Without a scope the cache is bypassed, so one student's results never reach another.
+kb_cache_scope: ContextVar[Optional[str]] = ContextVar("kb_cache_scope", default=None)
 
 # -----------------------------
 # TOOL: Retrieve from KB
 # -----------------------------
-@tool
-def retrieve_from_kb(query: str, max_results: Optional[int] = 3) -> str:
-    """
-    Retrieves data from Amazon Bedrock knowledge base.
+def _retrieve_from_kb(query: str, max_results: Optional[int] = 2) -> str:
+    """Blocking KB retrieval shared by the sync and async tools"""
+    scope = kb_cache_scope.get()
+    cache = kb_cache if scope is not None else None
+    cache_namespace = (scope, KNOWLEDGE_BASE_ID, max_results)
+    query_vector = None
+    if cache:
+        try:
+            # Repeated wording is answered before paying for an embedding
+            cached = cache.get_exact(cache_namespace, query)
+            if cached is None:
+                query_vector = cache.embed(query)
+                cached = cache.lookup(cache_namespace, query_vector)
+            if cached is not None:
+                logger.info("KB cache hit")
+                return cached
+        except Exception as e:
+            logger.warning("KB cache lookup failed: %s", e)
+            query_vector = None
 
-    Args:
-        query (str): The search query or question.
-        max_results (int, optional): Maximum number of results to return. Defaults to 3.
-
-    Returns:
-        str: Retrieved knowledge base results.
-    """
     try:
-        client = boto3.client(
-            'bedrock-agent-runtime',
-            region_name=BEDROCK_REGION,
-            aws_access_key_id=AWS_ACCESS_KEY_ID,
-            aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-        )
-
-        response = client.retrieve(
+        response = bedrock_agent_client.retrieve(
             knowledgeBaseId=KNOWLEDGE_BASE_ID,
             retrievalQuery={'text': query},
             retrievalConfiguration={
@@ -54,14 +111,14 @@ def retrieve_from_kb(query: str, max_results: Optional[int] = 3) -> str:
             }
         )
 
-        results = []
-        for result in response.get('retrievalResults', []):
-            content = result['content'].get('text', '')
-            score = result.get('score', 0)
-            results.append({
-                "score": round(score, 3),
-                "content": content
-            })
+        results = [
+            {
+                "score": round(result.get('score', 0), 3),
+                "content": result['content'].get('text', '')
+            }
+            for result in response.get('retrievalResults', ())
+            if result.get('score', 0) >= KB_MIN_SCORE
+        ]
 
         if not results:
             return json.dumps({
@@ -70,10 +127,13 @@ def retrieve_from_kb(query: str, max_results: Optional[int] = 3) -> str:
                 "message": "No results found."
             })
 
-        return json.dumps({
+        response_json = json.dumps({
             "status": "success",
             "results": results
         })
+        if cache and query_vector is not None:
+            cache.store(cache_namespace, query, query_vector, response_json)
+        return response_json
 
     except Exception as e:
         return json.dumps({
@@ -81,6 +141,57 @@ def retrieve_from_kb(query: str, max_results: Optional[int] = 3) -> str:
             "message": f"Error retrieving from knowledge base: {str(e)}"
         })
 
+@tool
+def retrieve_from_kb(query: str, max_results: Optional[int] = 2) -> str:
+    """
+    Retrieves data from Amazon Bedrock knowledge base.
+
+    Args:
+        query (str): The search query or question.
+        max_results (int, optional): Maximum number of results to return. Defaults to 2.
+
+    Returns:
+        str: Retrieved knowledge base results.
+    """
+    return _retrieve_from_kb(query, max_results)
+
+@tool
+async def aretrieve_from_kb(query: str, max_results: Optional[int] = 2) -> str:
+    """
+    Retrieves data from Amazon Bedrock knowledge base without blocking the event loop.
+
+    Args:
+        query (str): The search query or question.
+        max_results (int, optional): Maximum number of results to return. Defaults to 2.
+
+    Returns:
+        str: Retrieved knowledge base results.
+    """
+    return await asyncio.to_thread(_retrieve_from_kb, query, max_results)
+
+def _prefetched_kb_tool(prefetch_query: str, prefetch_max_results: int, prefetch: asyncio.Task):
+    """Build a KB tool that serves a speculative retrieval when the agent asks the same query"""
+    normalized_prefetch_query = prefetch_query.strip().lower()
+
+    @tool
+    async def aretrieve_from_kb(query: str, max_results: Optional[int] = None) -> str:
+        """
+        Retrieves data from Amazon Bedrock knowledge base without blocking the event loop.
+
+        Args:
+            query (str): The search query or question.
+            max_results (int, optional): Maximum number of results to return. Defaults to the caller's limit.
+
+        Returns:
+            str: Retrieved knowledge base results.
+        """
+        max_results = max_results or prefetch_max_results
+        if query.strip().lower() == normalized_prefetch_query and max_results == prefetch_max_results:
+            return await asyncio.shield(prefetch)
+        return await asyncio.to_thread(_retrieve_from_kb, query, max_results)
+
+    return aretrieve_from_kb
+
 # -----------------------------
 # TOOL: Log queries (stub)
 # -----------------------------
@@ -102,71 +213,11 @@ async def stream_async(payload):
     # Create an agent
     agent = create_agent()
 
-    buffer = ""
-    inside_thinking = False
-
-    async for chunk in agent.stream_async(user_prompt):
-        if "data" in chunk:
-            data = chunk["data"]
-            buffer += data
-            
-            # Process buffer for complete tags
-            while True:
-                if not inside_thinking:
-                    # Look for opening tag
-                    start = buffer.lower().find('<thinking>')
-                    if start != -1:
-                        # Yield everything before tag
-                        if start > 0:
-                            yield buffer[:start]
-                        buffer = buffer[start + 10:]  # Remove '<thinking>'
-                        inside_thinking = True
-                    else:
-                        # Check if buffer might contain partial opening tag
-                        safe_end = len(buffer)
-                        for i in range(min(10, len(buffer)), 0, -1):
-                            if buffer[-i:].lower() == '<thinking>'[:i]:
-                                safe_end = len(buffer) - i
-                                break
-                        
-                        # Yield safe content
-                        if safe_end > 0:
-                            yield buffer[:safe_end]
-                            buffer = buffer[safe_end:]
-                        break
-                else:
-                    # Look for closing tag
-                    end = buffer.lower().find('</thinking>')
-                    if end != -1:
-                        # Discard thinking content and remove closing tag
-                        buffer = buffer[end + 11:]  # Remove '</thinking>'
-                        inside_thinking = False
-                    else:
-                        # Check if buffer might contain partial closing tag
-                        if len(buffer) > 11:
-                            # Keep only enough to detect partial tag
-                            for i in range(min(11, len(buffer)), 0, -1):
-                                if buffer[-i:].lower() == '</thinking>'[:i]:
-                                    buffer = buffer[-(i):]
-                                    break
-                            else:
-                                # No partial match, discard all but last 11 chars
-                                buffer = buffer[-11:]
-                        break
-
-    # Flush remaining buffer (only if not inside thinking block)
-    if buffer and not inside_thinking:
-        yield buffer
+    # The handler reads this stream on its own task and coalesces it into frames
+    async for text in strip_thinking(agent.stream_async(user_prompt)):
+        yield text
     
-def create_agent() -> Agent:
-    modelWithGuardrail = BedrockModel(
-        model_id=config['bedrock']['model_id'],
-        # guardrail_id=config['bedrock']['guardrail_id'],         
-        # guardrail_version=config['bedrock']['guardrail_version'],                    
-        # guardrail_trace=config['bedrock']['guardrail_trace'],                
-    )
-
-    system_prompt = """You are Principal Aralyn, a seasoned educator with deep knowledge of the local education system's curriculum, policies, and academic standards. Your role is to assist students, parents, and staff with detailed curriculum inquiries.
+SYSTEM_PROMPT = """You are Principal Aralyn, a seasoned educator with deep knowledge of the local education system's curriculum, policies, and academic standards. Your role is to assist students, parents, and staff with detailed curriculum inquiries.
 
     YOUR PERSONA
 
@@ -209,69 +260,64 @@ def create_agent() -> Agent:
     "Anak, I'm happy to help you with this, but let me be clear about what's expected. Here's what you need to know... and here's what I need to see from you going forward. Kaya mo yan, but it requires focus and discipline."
     """
 
+@lru_cache(maxsize=1)
+def _get_model() -> BedrockModel:
+    """Build the Bedrock model once and reuse it across agents"""
+    config = _load_config()
+    if BEDROCK_REGION and BEDROCK_REGION != config['aws_region']:
+        logger.warning(
+            f"BEDROCK_REGION {BEDROCK_REGION} does not match configured region {config['aws_region']}; "
+            "cross-region model calls add latency"
+        )
+
+    return BedrockModel(
+        model_id=config['bedrock']['model_id'],
+        max_tokens=config['bedrock'].get('max_tokens'),
+        cache_prompt=config['bedrock'].get('cache_prompt'),
+        additional_args={
+            "performanceConfig": {"latency": config['bedrock'].get('latency', 'standard')}
+        },
+        # guardrail_id=config['bedrock']['guardrail_id'],         
+        # guardrail_version=config['bedrock']['guardrail_version'],                    
+        # guardrail_trace=config['bedrock']['guardrail_trace'],                
+    )
+
+DEFAULT_TOOLS = (aretrieve_from_kb,)
+
+def create_agent(tools: Optional[list] = None) -> Agent:
+    # Agents keep per-conversation message state, so only the model is shared
     return Agent(
         callback_handler=None,
-        tools=[retrieve_from_kb],
-        model=modelWithGuardrail,
-        system_prompt=system_prompt
+        tools=tools or DEFAULT_TOOLS,
+        model=_get_model(),
+        system_prompt=SYSTEM_PROMPT
     )
 
 # =========================NATATRIESMULTIAGENT
 @tool
-async def get_curriculum_context(query: str, max_kb_results: Optional[int] = 5) -> str:
+async def get_curriculum_context(query: str, max_kb_results: Optional[int] = 2) -> str:
     """
     Async function for other agents to get curriculum information.
     This function can be used as a tool by other agents (e.g., quizzer agent)
     to retrieve curriculum context before performing their tasks.
+    Pass max_kb_results up to 5 for broad or in-depth curriculum questions.
     """
+    max_kb_results = max_kb_results or 2
+    # Speculatively start the KB retrieval while the agent takes its first turn
+    prefetch = asyncio.create_task(
+        asyncio.to_thread(_retrieve_from_kb, query, max_kb_results)
+    )
+
     try:
-        logger.info(f"CURRICULUM AGENT CALLED with query: {query}")
+        logger.info("CURRICULUM AGENT CALLED with query: %s", query)
         
         # Create the curriculum agent
-        agent = create_agent()
-
-        buffer = ""
-        inside_thinking = False
-        final_response = ""  # Accumulate cleaned response
+        agent = create_agent(tools=[_prefetched_kb_tool(query, max_kb_results, prefetch)])
 
-        async for chunk in agent.stream_async(query):
-            if "data" in chunk:
-                data = chunk["data"]
-                buffer += data
-                
-                # Process buffer for complete tags
-                while True:
-                    if not inside_thinking:
-                        # Look for opening tag
-                        start = buffer.lower().find('<thinking>')
-                        if start != -1:
-                            # Save everything before tag
-                            if start > 0:
-                                final_response += buffer[:start]
-                            buffer = buffer[start + 10:]  # Remove '<thinking>'
-                            inside_thinking = True
-                        else:
-                            # No opening tag, save all but last 10 chars (partial tag safety)
-                            if len(buffer) > 10:
-                                final_response += buffer[:-10]
-                                buffer = buffer[-10:]
-                            break
-                    else:
-                        # Look for closing tag
-                        end = buffer.lower().find('</thinking>')
-                        if end != -1:
-                            # Discard everything up to and including closing tag
-                            buffer = buffer[end + 11:]  # Remove '</thinking>'
-                            inside_thinking = False
-                        else:
-                            # No closing tag yet, keep last 11 chars
-                            if len(buffer) > 11:
-                                buffer = buffer[-11:]
-                            break
-
-        # Flush remaining buffer
-        if buffer and not inside_thinking:
-            final_response += buffer
+        # Accumulate cleaned response
+        final_response = "".join([
+            text async for text in strip_thinking(agent.stream_async(query))
+        ])
 
         # Return structured response
         returned_response = json.dumps({
@@ -279,18 +325,27 @@ async def get_curriculum_context(query: str, max_kb_results: Optional[int] = 5)
             "query": query,
             "curriculum_response": final_response,
             "message": "Curriculum context retrieved successfully."
-        }, indent=2)
+        })
         
-        logger.info(f"CURRICULUM AGENT RESPONSE: \n{returned_response}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "CURRICULUM AGENT RESPONSE: len=%d sha=%s",
+                len(returned_response),
+                hashlib.blake2b(returned_response.encode(), digest_size=8).hexdigest()
+            )
         return returned_response
         
     except Exception as e:
-        logger.error(f"CURRI ERROR: {e}")
+        logger.exception("CURRI ERROR: %s", e)
         return json.dumps({
             "status": "error",
             "query": query,
             "message": f"Error getting curriculum context: {str(e)}"
-        }, indent=2)
+        })
+
+    finally:
+        if not prefetch.done():
+            prefetch.cancel()
 # @tool
 # def get_curriculum_context(query: str, max_kb_results: Optional[int] = 5) -> str:
 #     """
@@ -9,48 +9,101 @@ import json
 import boto3
 import os
 import asyncio
+import gzip
+import logging
+import re
+import shutil
+import tempfile
 import fitz
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, UTC
 from decimal import Decimal
+from functools import lru_cache
 from typing import Dict, List, Optional
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from strands import Agent, tool
 from strands.models import BedrockModel
-import sys
-sys.path.append('..')
 from chat_context import build_message_with_context
+from agents.utils.stream_utils import strip_thinking
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 BEDROCK_REGION = os.getenv("BEDROCK_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("ACCESS_KEY")
 AWS_SECRET_ACCESS_KEY = os.getenv("SECRET_KEY")
 
 CONFIG_PATH = "agents/config/curriculum_config.json"
-with open(CONFIG_PATH, "r") as f:
-    config = json.load(f)
 
-# AWS clients
+@lru_cache(maxsize=1)
+def _load_config() -> dict:
+    """Read the agent configuration on first use"""
+    with open(CONFIG_PATH, "r") as f:
+        return json.load(f)
+
+# AWS clients (module-scoped so warm containers reuse connections)
+client_config = Config(
+    max_pool_connections=32,
+    retries={"max_attempts": 5, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
 dynamodb = boto3.resource("dynamodb",
     region_name=BEDROCK_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
 )
 client = boto3.client("bedrock-runtime",
     region_name=BEDROCK_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
 )
 s3_client = boto3.client("s3",
     region_name=BEDROCK_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
 )
 
-# Model with Guardrails
-modelWithGuardrail = BedrockModel(
-    model_id=config['bedrock']['model_id'],
-    # guardrail_id=config['bedrock']['guardrail_id'],         
-    # guardrail_version=config['bedrock']['guardrail_version'],                    
-    # guardrail_trace=config['bedrock']['guardrail_trace'],                
-)
+# Ranged S3 downloads: parts fetched in parallel into one preallocated buffer
+S3_RANGE_SIZE = 8 * 1024 * 1024
+S3_RANGE_WORKERS = 16
+# Larger PDFs are spooled to /tmp and opened from disk instead of memory
+PDF_SPOOL_THRESHOLD = 128 * 1024 * 1024
+S3_COPY_BUFFER_SIZE = 1024 * 1024
+# Downloads are pinned to the HEAD's ETag; an overwrite mid-read restarts from a new HEAD
+S3_ETAG_RETRIES = 3
+# Extracted page texts are cached next to the source, keyed by its ETag
+PAGE_CACHE_PREFIX = "_cache"
+# Parsed documents kept in memory per warm container
+PAGE_MEMO_SIZE = 8
+
+# Model with Guardrails, built on the first request that needs Bedrock
+@lru_cache(maxsize=1)
+def _get_model() -> BedrockModel:
+    """Build the Bedrock model once and reuse it across agents"""
+    config = _load_config()
+    return BedrockModel(
+        model_id=config['bedrock']['model_id'],
+        # guardrail_id=config['bedrock']['guardrail_id'],         
+        # guardrail_version=config['bedrock']['guardrail_version'],                    
+        # guardrail_trace=config['bedrock']['guardrail_trace'],                
+    )
+
+# Routing replies are a short JSON dict, so output is capped and kept focused
+ROUTING_MAX_TOKENS = 256
+ROUTING_TEMPERATURE = 0.2
+
+@lru_cache(maxsize=1)
+def _get_routing_model() -> BedrockModel:
+    """Build the capped routing model once"""
+    return BedrockModel(
+        model_id=_load_config()['bedrock']['model_id'],
+        max_tokens=ROUTING_MAX_TOKENS,
+        temperature=ROUTING_TEMPERATURE,
+    )
 
 # TEMP_S3_KB = "kaisa-temp-bucket"
 # session_table = dynamodb.Table("KAISA-general-agent-session")
@@ -86,17 +139,112 @@ Here are the other agents in the KAISA system you can coordinate with:
    - Example triggers: "Summarize this lesson", "Create review notes", "Generate review PDF"
 """
 
+# System prompts for the per-call tool agents, built once at import
+ROUTING_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n\n"
+    "You are an expert at understanding student needs and routing them to the right agent.\n\n"
+    "DO NOT mention or invent agents outside of these"
+    f"{AGENT_DESCRIPTIONS}\n\n"
+    "Analyze the student's message and recommend which agent(s) would be most helpful."
+)
+
+GUIDANCE_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n"
+    "You specialize in giving personalized, encouraging learning guidance. "
+    "Be specific, practical, and motivating."
+)
+
+# Unambiguous trigger phrases per agent, matched before asking the model
+ROUTING_KEYWORDS = {
+    "Tallya": ("quiz", "quizzes", "practice questions", "assessment", "test my knowledge"),
+    "Kuya Revi": ("summarize", "summarise", "summary", "review notes", "reviewer", "review pdf"),
+    "Principal Aralyn": ("curriculum", "learning path", "lesson plan", "lesson plans", "plan my lessons"),
+}
+
+ROUTING_SHORTCUTS = {
+    "Tallya": {
+        "reasoning": "The student asked for a quiz or practice assessment, which is Tallya's specialty.",
+        "suggested_actions": ["Generate a quiz on the topic", "Check answers with instant feedback", "Track scores and progress"],
+        "kai_response": "Ay, quiz time! Tallya is the perfect classmate for this — she'll challenge you with practice questions and cheer you on. Tayo na!",
+    },
+    "Kuya Revi": {
+        "reasoning": "The student wants summaries or review material, which Kuya Revi prepares.",
+        "suggested_actions": ["Summarize the lesson", "Create a review outline", "Generate a personalized review PDF"],
+        "kai_response": "Kuya Revi is perfect for this! He'll help you summarize the lesson and build review notes step by step. Kaya mo 'yan!",
+    },
+    "Principal Aralyn": {
+        "reasoning": "The student is asking about the curriculum or planning their learning, which Principal Aralyn manages.",
+        "suggested_actions": ["Look up curriculum topics and standards", "Plan a learning path", "Organize lesson plans"],
+        "kai_response": "Principal Aralyn knows the curriculum inside out! She'll help you plan your learning path the proper way. Ay, salamat for asking!",
+    },
+}
+
+_KEYWORD_AGENTS = {
+    keyword: agent_name
+    for agent_name, keywords in ROUTING_KEYWORDS.items()
+    for keyword in keywords
+}
+# Longest phrases first so "lesson plans" wins over "lesson plan"
+_ROUTING_KEYWORD_RE = re.compile(
+    r"\b(" + "|".join(re.escape(k) for k in sorted(_KEYWORD_AGENTS, key=len, reverse=True)) + r")\b",
+    re.IGNORECASE,
+)
+
+def _keyword_route(user_message: str) -> Optional[Dict]:
+    """Route without the model when the message names exactly one agent's triggers"""
+    matched = {_KEYWORD_AGENTS[match.lower()] for match in _ROUTING_KEYWORD_RE.findall(user_message)}
+    if len(matched) != 1:
+        return None
+
+    agent_name = matched.pop()
+    shortcut = ROUTING_SHORTCUTS[agent_name]
+    return {
+        "recommended_agent": agent_name,
+        "reasoning": shortcut["reasoning"],
+        "suggested_actions": list(shortcut["suggested_actions"]),
+        "kai_response": shortcut["kai_response"],
+    }
+
 def _s3_client():
     """Initialize S3 client"""
     return s3_client
 
-def _read_s3_bytes(s3_uri: str) -> bytes:
-    """Read file bytes from S3"""
-    bucket = s3_uri.split("/")[2]
-    key = "/".join(s3_uri.split("/")[3:])
-    
-    resp = _s3_client().get_object(Bucket=bucket, Key=key)
-    return resp["Body"].read()
+def _read_s3_range(bucket: str, key: str, etag: str, view: memoryview, start: int) -> None:
+    """Read one byte range of an S3 object version into its slot of view"""
+    end = min(start + S3_RANGE_SIZE, len(view)) - 1
+    resp = _s3_client().get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=f'"{etag}"')
+    pos = start
+    for chunk in resp["Body"].iter_chunks(S3_COPY_BUFFER_SIZE):
+        view[pos : pos + len(chunk)] = chunk
+        pos += len(chunk)
+
+def _read_s3_bytes(bucket: str, key: str, etag: str, size: int) -> bytearray:
+    """Read file bytes of one S3 object version using parallel ranged GETs"""
+    buf = bytearray(size)
+    starts = range(0, size, S3_RANGE_SIZE)
+
+    with memoryview(buf) as view:
+        if len(starts) <= 1:
+            if size:
+                _read_s3_range(bucket, key, etag, view, 0)
+        else:
+            with ThreadPoolExecutor(max_workers=min(S3_RANGE_WORKERS, len(starts))) as pool:
+                # Consume results so errors from any part are raised here
+                list(pool.map(lambda start: _read_s3_range(bucket, key, etag, view, start), starts))
+
+    return buf
+
+def _spool_s3_object(bucket: str, key: str, etag: str) -> str:
+    """Stream an S3 object version to a temporary file and return its path"""
+    resp = _s3_client().get_object(Bucket=bucket, Key=key, IfMatch=f'"{etag}"')
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        try:
+            shutil.copyfileobj(resp["Body"], f, S3_COPY_BUFFER_SIZE)
+        except BaseException:
+            f.close()
+            os.remove(f.name)
+            raise
+    return f.name
 
 def _resolve_s3_source(
     s3_file_name: str,
@@ -118,23 +266,127 @@ def _resolve_s3_source(
 
     return bucket, key, s3_uri
 
-def _chunk_text(text: str, chunk_size: int | None) -> list[str]:
-    """Chunk text into smaller pieces"""
+def _open_pdf(source: bytes | bytearray | str) -> fitz.Document:
+    """Open a PDF from bytes or a file path"""
+    if isinstance(source, str):
+        return fitz.open(source, filetype="pdf")
+    return fitz.open(stream=source, filetype="pdf")
+
+def _extract_page_texts(source: bytes | bytearray | str) -> list[str]:
+    """Extract plain text per page from PDF bytes or a PDF file path"""
+    with _open_pdf(source) as doc:
+        return [doc.load_page(page_index).get_text("text") or "" for page_index in range(doc.page_count)]
+
+def _parse_page_texts(bucket: str, key: str, etag: str, size: int) -> list[str]:
+    """Download one version of a PDF from S3 and extract its page texts"""
+    if size > PDF_SPOOL_THRESHOLD:
+        path = _spool_s3_object(bucket, key, etag)
+        try:
+            return _extract_page_texts(path)
+        finally:
+            os.remove(path)
+
+    return _extract_page_texts(_read_s3_bytes(bucket, key, etag, size))
+
+def _read_cached_page_texts(bucket: str, cache_key: str) -> list[str] | None:
+    """Read previously extracted page texts, or None if not cached or unreadable"""
+    try:
+        resp = _s3_client().get_object(Bucket=bucket, Key=cache_key)
+        return json.loads(gzip.decompress(resp["Body"].read()))["pages"]
+    except Exception as e:
+        # Best-effort cache: a missing key, AccessDenied without s3:ListBucket,
+        # throttling or a corrupt entry all fall back to parsing the PDF
+        if not (isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404")):
+            logger.warning("Page text cache read failed for %s: %s", cache_key, e)
+        return None
+
+def _write_cached_page_texts(bucket: str, cache_key: str, page_texts: list[str]) -> None:
+    """Store extracted page texts; failures only cost a reparse next time"""
+    try:
+        _s3_client().put_object(
+            Bucket=bucket,
+            Key=cache_key,
+            Body=gzip.compress(json.dumps({"pages": page_texts}).encode("utf-8")),
+            ContentType="application/json",
+            ContentEncoding="gzip",
+        )
+    except Exception as e:
+        logger.warning("Page text cache write failed for %s: %s", cache_key, e)
+
+@lru_cache(maxsize=PAGE_MEMO_SIZE)
+def _extract_pages(bucket: str, key: str, etag: str, size: int) -> tuple[str, ...]:
+    """Every page's text for one version of a PDF, memoized by ETag"""
+    cache_key = f"{PAGE_CACHE_PREFIX}/{etag}.json.gz"
+
+    page_texts = _read_cached_page_texts(bucket, cache_key)
+    if page_texts is None:
+        page_texts = _parse_page_texts(bucket, key, etag, size)
+        _write_cached_page_texts(bucket, cache_key, page_texts)
+
+    return tuple(page_texts)
+
+def _load_page_texts(bucket: str, key: str) -> tuple[str, ...]:
+    """Return every page's text for a PDF in S3"""
+    for attempt in range(S3_ETAG_RETRIES + 1):
+        head = _s3_client().head_object(Bucket=bucket, Key=key)
+        try:
+            return _extract_pages(bucket, key, head["ETag"].strip('"'), head["ContentLength"])
+        except ClientError as e:
+            # 412: the object was overwritten after the HEAD; nothing was memoized or cached
+            error = e.response.get("Error", {})
+            if error.get("Code") not in ("PreconditionFailed", "412") or attempt == S3_ETAG_RETRIES:
+                raise
+            logger.info("%s changed during download, retrying from a fresh HEAD", key)
+
+def _join_prefix(parts: tuple[str, ...], limit: int) -> str:
+    """Return "\n".join(parts)[:limit] without building the joined string"""
+    head: list[str] = []
+    remaining = limit
+    for index, part in enumerate(parts):
+        for piece in (("\n", part) if index else (part,)):
+            if remaining >= len(piece):
+                head.append(piece)
+                remaining -= len(piece)
+            else:
+                head.append(piece[:remaining])
+                return "".join(head)
+    return "".join(head)
+
+def _next_section_offset(page_texts: tuple[str, ...], preview_chars: int, chunk_size: int) -> int:
+    """Index of the first fetch_document_sections section not fully in the preview"""
+    consumed = 0
+    section = 0
+    for index, page_text in enumerate(page_texts):
+        if index:
+            consumed += 1  # page separator
+        for _, end in _chunk_spans(len(page_text), chunk_size):
+            if consumed + end > preview_chars:
+                return section
+            section += 1
+        consumed += len(page_text)
+    return section
+
+def _chunk_spans(length: int, chunk_size: int | None) -> list[tuple[int, int]]:
+    """Compute (start, end) offsets for chunking text of the given length"""
     if not chunk_size or chunk_size <= 0:
-        return [text]
-    return [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
-
-# def db_save_document(session_id: str, file_name: str, s3_uri: str, total_chars: int, content_preview: str) -> Dict:
-#     """Save document metadata to DynamoDB"""
-#     documents_table.put_item(Item={
-#         "session_id": session_id,
-#         "file_name": file_name,
-#         "s3_uri": s3_uri,
-#         "total_chars": Decimal(total_chars),
-#         "content_preview": content_preview[:1000],  # Store first 1000 chars
-#         "uploaded_at": datetime.now(UTC).isoformat()
-#     })
-#     return {"status": "document_saved"}
+        return [(0, length)]
+    return [(i, min(i + chunk_size, length)) for i in range(0, length, chunk_size)]
+
+# def db_save_documents(session_id: str, documents: List[Dict]) -> Dict:
+#     """Save document metadata to DynamoDB in 25-item batches"""
+#     uploaded_at = datetime.now(UTC).isoformat()
+#     # Throttled writes are retried by the adaptive retry mode in client_config
+#     with documents_table.batch_writer(overwrite_by_pkeys=["session_id", "file_name"]) as batch:
+#         for document in documents:
+#             batch.put_item(Item={
+#                 "session_id": session_id,
+#                 "file_name": document["file_name"],
+#                 "s3_uri": document["s3_uri"],
+#                 "total_chars": Decimal(document["total_chars"]),
+#                 "content_preview": document["content_preview"][:1000],  # Store first 1000 chars
+#                 "uploaded_at": uploaded_at
+#             })
+#     return {"status": "documents_saved", "count": len(documents)}
 
 @tool
 def fetch_document_text(
@@ -155,7 +407,10 @@ def fetch_document_text(
         s3_prefix: S3 key prefix (if None, uses default path)
     
     Returns:
-        Dictionary with s3_uri, total chars, page breakdown, and text preview
+        Dictionary with s3_uri, total chars, page count, and text preview.
+        When the document overflows the preview, next_offset is the section
+        offset to pass to fetch_document_sections (with the same max_chars)
+        to continue reading.
     """
     try:
         bucket, key, s3_uri = _resolve_s3_source(
@@ -168,39 +423,32 @@ def fetch_document_text(
         return {"error": str(config_error)}
 
     try:
-        data = _read_s3_bytes(s3_uri)
-        doc = fitz.open(stream=data, filetype="pdf")
-
-        page_texts: list[str] = []
-        total_chars = 0
-
-        for page in doc:
-            page_text = page.get_text() or ""
-            page_texts.append(page_text)
-            total_chars += len(page_text)
-
-        doc.close()
-
-        full_text = "\n".join(page_texts)
-        preview_limit = max_chars if max_chars and max_chars > 0 else None
-        text_preview = full_text[:preview_limit] if preview_limit else full_text
-        overflow = len(full_text) > len(text_preview)
+        # The memo holds the whole document; max_chars only limits the slice returned
+        page_texts = _load_page_texts(bucket, key)
+        page_count = len(page_texts)
+        total_chars = sum(map(len, page_texts))
+
+        # Length of "\n".join(page_texts), without materializing it
+        joined_chars = total_chars + max(page_count - 1, 0)
+        preview_limit = max_chars if max_chars and max_chars > 0 else joined_chars
+        overflow = joined_chars > preview_limit
+        if overflow:
+            text_preview = _join_prefix(page_texts, preview_limit)
+        else:
+            text_preview = "\n".join(page_texts)
 
         # Save document metadata
-        # db_save_document(session_id, s3_file_name, s3_uri, total_chars, text_preview)
+        # db_save_documents(session_id, [{"file_name": s3_file_name, "s3_uri": s3_uri, "total_chars": total_chars, "content_preview": text_preview}])
 
         response: dict[str, object] = {
             "s3_uri": s3_uri,
             "total_chars": total_chars,
             "text": text_preview,
             "overflow": overflow,
-            "page_count": len(page_texts),
-            "pages": page_texts,
+            "page_count": page_count,
+            "next_offset": _next_section_offset(page_texts, preview_limit, preview_limit) if overflow else None,
         }
 
-        if overflow:
-            response["remaining_text"] = full_text[len(text_preview):]
-
         return response
 
     except Exception as e:
@@ -242,45 +490,40 @@ def fetch_document_sections(
         return {"error": str(config_error)}
 
     try:
-        data = _read_s3_bytes(s3_uri)
-        doc = fitz.open(stream=data, filetype="pdf")
-
-        page_texts: list[str] = []
-        total_chars = 0
-
-        for page in doc:
-            page_text = page.get_text() or ""
-            page_texts.append(page_text)
-            total_chars += len(page_text)
-
-        doc.close()
+        page_texts = _load_page_texts(bucket, key)
+        total_chars = sum(map(len, page_texts))
 
         chunk_size = max_chars if max_chars and max_chars > 0 else None
-        sections_all: list[dict[str, object]] = []
 
+        # Only offsets are computed for every section; text is sliced for the
+        # returned window alone
+        section_spans: list[tuple[int, int, int, int, int]] = []
         for page_index, page_text in enumerate(page_texts):
-            page_chunks = _chunk_text(page_text, chunk_size)
-            for chunk_index, chunk in enumerate(page_chunks):
-                section_label = f"Page {page_index + 1}"
-                if len(page_chunks) > 1:
-                    section_label = f"{section_label} - part {chunk_index + 1}"
-
-                section_payload: dict[str, object] = {
-                    "section": section_label,
-                    "page": page_index + 1,
-                    "text": chunk,
-                }
-
-                if len(page_chunks) > 1:
-                    section_payload["part"] = chunk_index + 1
+            page_spans = _chunk_spans(len(page_text), chunk_size)
+            for chunk_index, (start, end) in enumerate(page_spans):
+                section_spans.append((page_index, chunk_index, len(page_spans), start, end))
 
-                sections_all.append(section_payload)
-
-        total_sections = len(sections_all)
+        total_sections = len(section_spans)
         safe_offset = max(offset, 0)
         safe_limit = limit if limit and limit > 0 else total_sections
         end_index = min(safe_offset + safe_limit, total_sections)
-        selected_sections = sections_all[safe_offset:end_index]
+
+        selected_sections: list[dict[str, object]] = []
+        for page_index, chunk_index, part_count, start, end in section_spans[safe_offset:end_index]:
+            section_label = f"Page {page_index + 1}"
+            if part_count > 1:
+                section_label = f"{section_label} - part {chunk_index + 1}"
+
+            section_payload: dict[str, object] = {
+                "section": section_label,
+                "page": page_index + 1,
+                "text": page_texts[page_index][start:end],
+            }
+
+            if part_count > 1:
+                section_payload["part"] = chunk_index + 1
+
+            selected_sections.append(section_payload)
 
         has_more = end_index < total_sections
         next_offset = end_index if has_more else None
@@ -301,34 +544,20 @@ def fetch_document_sections(
     except Exception as e:
         return {"error": str(e)}
 
-@tool
-def analyze_and_route_query(
-    user_message: str,
-    document_context: Optional[str] = None,
-) -> Dict:
-    """
-    Analyze student's query and determine best agent to route to
-    
-    Args:
-        user_message: Student's question or request
-        document_context: Optional document content for context
-    
-    Returns:
-        Dict with recommended agent, reason, and suggested actions
-    """
-    routing_agent = Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n\n"
-        "You are an expert at understanding student needs and routing them to the right agent.\n\n"
-        "DO NOT mention or invent agents outside of these"
-        f"{AGENT_DESCRIPTIONS}\n\n"
-        "Analyze the student's message and recommend which agent(s) would be most helpful.",
+@lru_cache(maxsize=1)
+def _routing_agent() -> Agent:
+    """Build the routing agent once per warm container"""
+    return Agent(
+        model=_get_routing_model(),
+        system_prompt=ROUTING_SYSTEM_PROMPT,
         callback_handler=None
     )
-    
+
+def _routing_prompt(user_message: str, document_context: Optional[str]) -> str:
+    """Build the routing prompt for a student's message"""
     context_str = f"Document context:\n{document_context}\n\n" if document_context else ""
     
-    prompt = f"""
+    return f"""
     {context_str}
     Student's message: "{user_message}"
     
@@ -340,15 +569,15 @@ def analyze_and_route_query(
     
     Return ONLY valid JSON, no markdown or extra text.
     """
-    
-    response = routing_agent(prompt)
-    
+
+def _parse_routing_response(content: str) -> Dict:
+    """Parse the routing agent's JSON reply, falling back to Teacher KAI"""
     try:
-        content = str(response)
+        # partition stops at the first fence instead of splitting the whole reply
         if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
+            content = content.partition("```json")[2].partition("```")[0].strip()
         elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
+            content = content.partition("```")[2].partition("```")[0].strip()
         
         routing_result = json.loads(content)
         return routing_result
@@ -359,8 +588,76 @@ def analyze_and_route_query(
             "kai_response": "Let me help you figure out what you need! Can you tell me a bit more about what you're trying to do?"
         }
 
+@lru_cache(maxsize=1)
+def _guidance_agent() -> Agent:
+    """Build the guidance agent once per warm container"""
+    return Agent(
+        model=_get_model(),
+        system_prompt=GUIDANCE_SYSTEM_PROMPT
+    )
+
+def _guidance_prompt(student_grade: int, topic: str, document_context: Optional[str]) -> str:
+    """Build the learning guidance prompt"""
+    context_str = f"Document material:\n{document_context}\n\n" if document_context else ""
+    
+    return f"""
+    {context_str}
+    Provide learning guidance for a Grade {student_grade} student about: "{topic}"
+    
+    Your guidance should:
+    1. Acknowledge their learning goals
+    2. Break down the topic in an age-appropriate way
+    3. Suggest a learning pathway
+    4. Mention which KAISA agents can help at each step
+    5. End with an encouraging message in Taglish
+    
+    Be warm, supportive, and engaging!
+    """
+
+# Shared agents keep conversation history, so each one-shot call starts from an
+# empty conversation and calls on the same agent are serialized. The tools run
+# on the handler's single event loop, so asyncio locks are enough
+_AGENT_LOCKS = {"routing": asyncio.Lock(), "guidance": asyncio.Lock()}
+
+async def _ask(agent: Agent, lock_name: str, prompt: str) -> str:
+    """Run one prompt on a shared agent without carrying over earlier turns"""
+    async with _AGENT_LOCKS[lock_name]:
+        agent.messages = []
+        return str(await agent.invoke_async(prompt))
+
+async def _aroute_query(user_message: str, document_context: Optional[str]) -> Dict:
+    """Route a query without blocking the event loop"""
+    # Common requests are routed by keyword, skipping a Bedrock round-trip
+    routing_result = _keyword_route(user_message)
+    if routing_result:
+        return routing_result
+
+    response = await _ask(_routing_agent(), "routing", _routing_prompt(user_message, document_context))
+    return _parse_routing_response(response)
+
+async def _agenerate_guidance(student_grade: int, topic: str, document_context: Optional[str]) -> str:
+    """Generate learning guidance without blocking the event loop"""
+    return await _ask(_guidance_agent(), "guidance", _guidance_prompt(student_grade, topic, document_context))
+
 @tool
-def generate_learning_guidance(
+async def analyze_and_route_query(
+    user_message: str,
+    document_context: Optional[str] = None,
+) -> Dict:
+    """
+    Analyze student's query and determine best agent to route to
+    
+    Args:
+        user_message: Student's question or request
+        document_context: Optional document content for context
+    
+    Returns:
+        Dict with recommended agent, reason, and suggested actions
+    """
+    return await _aroute_query(user_message, document_context)
+
+@tool
+async def generate_learning_guidance(
     student_grade: int,
     topic: str,
     document_context: Optional[str] = None,
@@ -376,36 +673,39 @@ def generate_learning_guidance(
     Returns:
         Personalized guidance message in Taglish
     """
-    guidance_agent = Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n"
-        "You specialize in giving personalized, encouraging learning guidance. "
-        "Be specific, practical, and motivating."
-    )
-    
-    context_str = f"Document material:\n{document_context}\n\n" if document_context else ""
+    return await _agenerate_guidance(student_grade, topic, document_context)
+
+@tool
+async def route_and_guide(
+    user_message: str,
+    student_grade: int,
+    topic: str,
+    document_context: Optional[str] = None,
+) -> Dict:
+    """
+    Route the student's query and generate learning guidance in one step
     
-    prompt = f"""
-    {context_str}
-    Provide learning guidance for a Grade {student_grade} student about: "{topic}"
+    Both model calls run concurrently, so this takes as long as the slower one.
     
-    Your guidance should:
-    1. Acknowledge their learning goals
-    2. Break down the topic in an age-appropriate way
-    3. Suggest a learning pathway
-    4. Mention which KAISA agents can help at each step
-    5. End with an encouraging message in Taglish
+    Args:
+        user_message: Student's question or request
+        student_grade: Student's grade level (K-12)
+        topic: Learning topic or subject
+        document_context: Optional document content for context
     
-    Be warm, supportive, and engaging!
+    Returns:
+        Dict with the routing result and the guidance message
     """
-    
-    response = guidance_agent(prompt)
-    return str(response)
+    routing, guidance = await asyncio.gather(
+        _aroute_query(user_message, document_context),
+        _agenerate_guidance(student_grade, topic, document_context),
+    )
+    return {"routing": routing, "guidance": guidance}
 
 def create_orchestrator() -> Agent:
     """Create the main Teacher KAI general agent"""
     return Agent(
-        model=modelWithGuardrail,
+        model=_get_model(),
         system_prompt=f"{BASE_PERSONA}\n\n"
         "You are the general agent of the KAISA learning system.\n"
         "Your role is to:\n"
@@ -415,15 +715,16 @@ def create_orchestrator() -> Agent:
         "4. Track their learning journey and offer encouragement\n\n"
 
         f"{AGENT_DESCRIPTIONS}\n\n"
-        "DO NOT mention or invent agents outside of these"
-
-        # "AVAILABLE TOOLS:\n"
-        # # "- fetch_document_text: Load and analyze documents students upload\n"
-        # # "- fetch_document_sections: Get paginated document content\n"
-        # "- analyze_and_route_query: Determine best agent for student's needs\n"
-        # "- generate_learning_guidance: Provide personalized learning paths\n\n"
-        # "COMMON WORKFLOWS:\n"
-        # "- Guiding on path: Use analyze_and_route_query → generate_learning_guidance\n"
+        "DO NOT mention or invent agents outside of these\n\n"
+
+        "AVAILABLE TOOLS:\n"
+        # "- fetch_document_text: Load and analyze documents students upload\n"
+        # "- fetch_document_sections: Get paginated document content\n"
+        "- analyze_and_route_query: Determine best agent for student's needs\n"
+        "- generate_learning_guidance: Provide personalized learning paths\n"
+        "- route_and_guide: Route and give guidance in one step (runs both concurrently)\n\n"
+        "COMMON WORKFLOWS:\n"
+        "- Guiding on path: Use route_and_guide, or analyze_and_route_query → generate_learning_guidance\n\n"
         "YOUR APPROACH:\n"
         "1. Be warm and encouraging — make students feel supported\n"
         "2. Listen carefully to understand what students need\n"
@@ -433,12 +734,13 @@ def create_orchestrator() -> Agent:
         
         "Remember: You're their main guide! Make learning feel fun and achievable.\n"
         "Use natural conversation use markdown with proper line spacing (double line space as needed) as your final response.",
-        # tools=[
-        #     # fetch_document_text,
-        #     # fetch_document_sections,
-        #     # analyze_and_route_query,
-        #     # generate_learning_guidance,
-        # ],
+        tools=[
+            # fetch_document_text,
+            # fetch_document_sections,
+            analyze_and_route_query,
+            generate_learning_guidance,
+            route_and_guide,
+        ],
     )
 
 async def stream_async(payload):
@@ -447,73 +749,42 @@ async def stream_async(payload):
     session_id = payload.get("session_id", "default")
     file_input = payload.get("file_input", None)
     
-    orchestrator = create_orchestrator()
-    
-    # Add chat context to user prompt
-    user_prompt = build_message_with_context(session_id, user_prompt)
-    
-    # If file is uploaded, fetch content and include in prompt
+    # Start fetching the uploaded file so S3 and parsing overlap with the chat context lookup
+    doc_task = None
     if file_input and file_input.s3_file_name:
-        try:
-            doc_data = fetch_document_text(session_id, file_input.s3_file_name)
-            file_content = doc_data.get("text", "")
-            user_prompt = f"[Document: {file_input.file_name}]\n{file_content}\n\n{user_prompt}"
-        except Exception as e:
-            user_prompt = f"[Document uploaded: {file_input.file_name} - Error reading content]\n\n{user_prompt}"
+        doc_task = asyncio.create_task(
+            asyncio.to_thread(fetch_document_text, session_id, file_input.s3_file_name)
+        )
     
-    buffer = ""
-    inside_thinking = False
-
-    async for chunk in orchestrator.stream_async(user_prompt):
-        if "data" in chunk:
-            data = chunk["data"]
-            buffer += data
-            
-            # Process buffer for complete tags
-            while True:
-                if not inside_thinking:
-                    # Look for opening tag
-                    start = buffer.lower().find('<thinking>')
-                    if start != -1:
-                        # Yield everything before tag
-                        if start > 0:
-                            yield buffer[:start]
-                        buffer = buffer[start + 10:]  # Remove '<thinking>'
-                        inside_thinking = True
-                    else:
-                        # Check if buffer might contain partial opening tag
-                        safe_end = len(buffer)
-                        for i in range(min(10, len(buffer)), 0, -1):
-                            if buffer[-i:].lower() == '<thinking>'[:i]:
-                                safe_end = len(buffer) - i
-                                break
-                        
-                        # Yield safe content
-                        if safe_end > 0:
-                            yield buffer[:safe_end]
-                            buffer = buffer[safe_end:]
-                        break
-                else:
-                    # Look for closing tag
-                    end = buffer.lower().find('</thinking>')
-                    if end != -1:
-                        # Discard thinking content and remove closing tag
-                        buffer = buffer[end + 11:]  # Remove '</thinking>'
-                        inside_thinking = False
-                    else:
-                        # Check if buffer might contain partial closing tag
-                        if len(buffer) > 11:
-                            # Keep only enough to detect partial tag
-                            for i in range(min(11, len(buffer)), 0, -1):
-                                if buffer[-i:].lower() == '</thinking>'[:i]:
-                                    buffer = buffer[-(i):]
-                                    break
-                            else:
-                                # No partial match, discard all but last 11 chars
-                                buffer = buffer[-11:]
-                        break
-
-    # Flush remaining buffer (only if not inside thinking block)
-    if buffer and not inside_thinking:
-        yield buffer
+    # Unambiguous requests are routed up front, so the orchestrator can answer
+    # without a routing tool round-trip
+    routing_result = _keyword_route(user_prompt)
+    
+    try:
+        orchestrator = create_orchestrator()
+        
+        # Add chat context to user prompt
+        user_prompt = await asyncio.to_thread(build_message_with_context, session_id, user_prompt)
+        
+        if routing_result:
+            user_prompt = (
+                f"[Routing: {json.dumps(routing_result, ensure_ascii=False)}\n"
+                "This request is already routed; do not call analyze_and_route_query.]\n\n"
+                f"{user_prompt}"
+            )
+        
+        # If file is uploaded, include its content in prompt
+        if doc_task:
+            try:
+                doc_data = await doc_task
+                file_content = doc_data.get("text", "")
+                user_prompt = f"[Document: {file_input.file_name}]\n{file_content}\n\n{user_prompt}"
+            except Exception as e:
+                user_prompt = f"[Document uploaded: {file_input.file_name} - Error reading content]\n\n{user_prompt}"
+        
+        async for text in strip_thinking(orchestrator.stream_async(user_prompt)):
+            yield text
+    finally:
+        if doc_task and not doc_task.done():
+            doc_task.cancel()
 
@@ -9,16 +9,16 @@ import json
 import boto3
 import os
 import asyncio
+from contextvars import ContextVar
 from datetime import datetime, UTC
-from decimal import Decimal
+from functools import lru_cache
 from typing import Dict, List, Optional
+from botocore.config import Config
 from strands import Agent, tool
 from strands.models import BedrockModel
-import sys
-sys.path.append('..')
 from chat_context import build_message_with_context
-from agents import curriculum_agent, review_agent, general_agent
 from agents.curriculum_agent import get_curriculum_context
+from agents.utils.stream_utils import strip_thinking
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,23 +31,43 @@ AWS_SECRET_ACCESS_KEY = os.getenv("SECRET_KEY")
 KNOWLEDGE_BASE_ID = os.getenv("KB_ID")
 
 CONFIG_PATH = "agents/config/quizzer_config.json"
-with open(CONFIG_PATH, "r") as f:
-    config = json.load(f)
 
-# AWS clients
+@lru_cache(maxsize=1)
+def _load_config() -> dict:
+    """Read the agent configuration on first use"""
+    with open(CONFIG_PATH, "r") as f:
+        return json.load(f)
+
+# AWS clients (module-scoped so warm containers reuse connections)
+client_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=50,
+    connect_timeout=3,
+    retries={"max_attempts": 3, "mode": "standard"},
+)
 dynamodb = boto3.resource("dynamodb",
     region_name=BEDROCK_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    # DynamoDB answers quickly; a stuck read is retried rather than waited on
+    config=client_config.merge(Config(read_timeout=10))
 )
 client = boto3.client("bedrock-runtime",
     region_name=BEDROCK_REGION,
     aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+    config=client_config
 )
 quiz_table = dynamodb.Table("KAISA-quiz-agent-qna")
 session_table = dynamodb.Table("KAISA-quiz-agent-quiz-session")
 
+_JSON_DECODER = json.JSONDecoder()
+
+# Session chat history keeps at least the last HISTORY_KEEP_TURNS turns; it is
+# appended in place and only trimmed once it reaches HISTORY_MAX_TURNS
+HISTORY_KEEP_TURNS = 20
+HISTORY_MAX_TURNS = 40
+
 # Base persona for all Tallya agents
 BASE_PERSONA = """
 You are Tallya — a competitive, confident, and helpful K–12 classmate.
@@ -56,38 +76,103 @@ When explaining, be structured but fun.
 You remember what we talked about earlier in the session.
 """
 
-# Model with Guardrails
-modelWithGuardrail = BedrockModel(
-    model_id=config['bedrock']['model_id'],
-    # guardrail_id=config['bedrock']['guardrail_id'],         
-    # guardrail_version=config['bedrock']['guardrail_version'],                    
-    # guardrail_trace=config['bedrock']['guardrail_trace'],                
+# System prompts for the per-call tool agents, built once at import
+QUIZ_GEN_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n"
+    "You are an expert at creating educational quiz questions. "
+    "Generate engaging, age-appropriate multiple-choice questions. "
+    "Each question must have exactly 4 options (A, B, C, D) with one correct answer."
+)
+
+FEEDBACK_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n"
+    "You specialize in giving encouraging, educational feedback. "
+    "Mix English and Filipino naturally. Be supportive and helpful."
+)
+
+EXPLAIN_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n"
+    "You are an expert at explaining complex concepts simply. "
+    "Break things down step-by-step for K-12 students. "
+    "Use examples, analogies, and mnemonics."
 )
 
-def db_save_quiz(session_id: str, quiz_items: List[Dict], topic: str, grade: int) -> Dict:
+CHAT_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n"
+    "You maintain conversational context and respond naturally to student messages. "
+    "Reference their quiz progress and previous interactions when relevant."
+)
+
+# Model with Guardrails, built on the first request that needs Bedrock
+@lru_cache(maxsize=1)
+def _get_model() -> BedrockModel:
+    """Build the Bedrock model once and reuse it across agents"""
+    config = _load_config()
+    return BedrockModel(
+        model_id=config['bedrock']['model_id'],
+        # guardrail_id=config['bedrock']['guardrail_id'],         
+        # guardrail_version=config['bedrock']['guardrail_version'],                    
+        # guardrail_trace=config['bedrock']['guardrail_trace'],                
+    )
+
+# Questions read during the current stream_async call, keyed by (session_id, q_index);
+# None outside a request so nothing is cached across requests
+_question_memo: ContextVar[Optional[Dict]] = ContextVar("question_memo", default=None)
+
+def _forget_questions(session_id: str, q_index: Optional[int] = None) -> None:
+    """Drop memoized questions after they are written"""
+    memo = _question_memo.get()
+    if memo is None:
+        return
+    if q_index is not None:
+        memo.pop((session_id, q_index), None)
+        return
+    for key in [key for key in memo if key[0] == session_id]:
+        del memo[key]
+
+def _now_iso() -> str:
+    """Current UTC time as stored in the quiz tables"""
+    return datetime.now(UTC).isoformat()
+
+def db_save_quiz(
+    session_id: str,
+    quiz_items: List[Dict],
+    topic: str,
+    grade: int,
+    now_iso: Optional[str] = None
+) -> Dict:
     """Save quiz items to DynamoDB"""
-    for i, q in enumerate(quiz_items):
-        quiz_table.put_item(Item={
-            "session_id": session_id,
-            "q_index": i,
-            "question": q["question"],
-            "options": q["options"],
-            "correct": q["correct"],
-            "explanation": q.get("explanation", ""),
-            "topic": topic,
-            "grade": grade,
-            "created_at": datetime.now(UTC).isoformat()
-        })
+    now_iso = now_iso or _now_iso()
+    _forget_questions(session_id)
+    # batch_writer sends up to 25 puts per BatchWriteItem and resends unprocessed items
+    with quiz_table.batch_writer() as batch:
+        for i, q in enumerate(quiz_items):
+            batch.put_item(Item={
+                "session_id": session_id,
+                "q_index": i,
+                "question": q["question"],
+                "options": q["options"],
+                "correct": q["correct"],
+                "explanation": q.get("explanation", ""),
+                "topic": topic,
+                "grade": grade,
+                "created_at": now_iso
+            })
     return {"items_saved": len(quiz_items)}
 
 @tool
 def db_get_question(session_id: str, q_index: int) -> Dict:
     """Retrieve a question from DynamoDB"""
+    memo = _question_memo.get()
+    memo_key = (session_id, q_index)
+    if memo is not None and memo_key in memo:
+        return dict(memo[memo_key])
+
     res = quiz_table.get_item(Key={"session_id": session_id, "q_index": q_index})
     item = res.get("Item")
     if not item:
         return {"error": "Question not found"}
-    return {
+    question = {
         "question": item["question"],
         "options": item["options"],
         "correct": item["correct"],
@@ -96,22 +181,11 @@ def db_get_question(session_id: str, q_index: int) -> Dict:
         "grade": item.get("grade", 0),
         "user_answer": item.get("user_answer", "")
     }
+    if memo is not None:
+        memo[memo_key] = question
+    return dict(question)
 
 
-def db_update_question_answer(session_id: str, q_index: int, user_answer: str, is_correct: bool) -> Dict:
-    """Update question with user's answer in DynamoDB"""
-    status = "correct" if is_correct else "wrong"
-    quiz_table.update_item(
-        Key={"session_id": session_id, "q_index": q_index},
-        UpdateExpression="SET user_answer=:a, score_status=:s, answered_at=:t",
-        ExpressionAttributeValues={
-            ":a": user_answer.upper(),
-            ":s": status,
-            ":t": datetime.now(UTC).isoformat()
-        }
-    )
-    return {"status": "updated"}
-
 @tool
 def db_get_session(session_id: str) -> Dict:
     """Retrieve session data from DynamoDB"""
@@ -128,58 +202,72 @@ def db_get_session(session_id: str) -> Dict:
         "score": int(session.get("score", 0)),
         "topic": session.get("topic", ""),
         "grade": int(session.get("grade", 0)),
-        "history": session.get("history", []),
+        "history": session.get("history", [])[-HISTORY_KEEP_TURNS:],
         "started_at": session.get("started_at", ""),
         "updated_at": session.get("updated_at", "")
     }
 
 
-def db_update_session_progress(
+def db_record_answer(
     session_id: str,
-    score: Optional[int] = None,
-    current_question: Optional[int] = None,
-    state: Optional[str] = None
+    q_index: int,
+    user_answer: str,
+    is_correct: bool,
+    current_question: int,
+    total_questions: int,
+    now_iso: Optional[str] = None
 ) -> Dict:
-    """Update session progress in DynamoDB"""
-    update_parts = ["updated_at=:u"]
-    expr_values = {":u": datetime.now(UTC).isoformat()}
-    expr_names = {}
-    
-    if score is not None:
-        update_parts.append("score=:sc")
-        expr_values[":sc"] = Decimal(score)
-    
-    if current_question is not None:
-        update_parts.append("current_question=:cq")
-        expr_values[":cq"] = Decimal(current_question)
-    
-    if state is not None:
-        update_parts.append("#state=:st")
-        expr_values[":st"] = state
-        expr_names["#state"] = "state"
-    
-    update_expr = "SET " + ", ".join(update_parts)
-    
-    kwargs = {
+    """Save an answer and advance session progress in one transaction"""
+    _forget_questions(session_id, q_index)
+    now = now_iso or _now_iso()
+    # current_question and total_questions come from the session already read
+    # by the caller, so the last answer closes the session in the same write
+    is_last = current_question + 1 >= total_questions
+    session_update = {
+        "TableName": session_table.name,
         "Key": {"session_id": session_id},
-        "UpdateExpression": update_expr,
-        "ExpressionAttributeValues": expr_values
+        "UpdateExpression": "SET updated_at=:u ADD score :delta, current_question :one",
+        # ADD would otherwise create a bare session item
+        "ConditionExpression": "attribute_exists(session_id)",
+        "ExpressionAttributeValues": {
+            ":u": now,
+            ":delta": 1 if is_correct else 0,
+            ":one": 1
+        }
     }
-    
-    if expr_names:
-        kwargs["ExpressionAttributeNames"] = expr_names
-    
-    session_table.update_item(**kwargs)
-    return {"status": "updated"}
+    if is_last:
+        session_update["UpdateExpression"] = "SET updated_at=:u, #state=:st ADD score :delta, current_question :one"
+        session_update["ExpressionAttributeNames"] = {"#state": "state"}
+        session_update["ExpressionAttributeValues"][":st"] = "completed"
+
+    dynamodb.meta.client.transact_write_items(TransactItems=[
+        {
+            "Update": {
+                "TableName": quiz_table.name,
+                "Key": {"session_id": session_id, "q_index": q_index},
+                "UpdateExpression": "SET user_answer=:a, score_status=:s, answered_at=:t",
+                "ExpressionAttributeValues": {
+                    ":a": user_answer.upper(),
+                    ":s": "correct" if is_correct else "wrong",
+                    ":t": now
+                }
+            }
+        },
+        {"Update": session_update}
+    ])
+
+    return {"status": "updated", "state": "completed" if is_last else "in_progress"}
 
 
 def db_create_session(
     session_id: str,
     total_questions: int,
     topic: str,
-    grade: int
+    grade: int,
+    now_iso: Optional[str] = None
 ) -> Dict:
     """Create a new session in DynamoDB"""
+    now_iso = now_iso or _now_iso()
     session_table.put_item(Item={
         "session_id": session_id,
         "current_question": 0,
@@ -189,32 +277,59 @@ def db_create_session(
         "state": "in_progress",
         "topic": topic,
         "grade": grade,
-        "started_at": datetime.now(UTC).isoformat(),
-        "updated_at": datetime.now(UTC).isoformat()
+        "started_at": now_iso,
+        "updated_at": now_iso
     })
     return {"status": "created"}
 
 
-def db_add_to_chat_history(session_id: str, student_message: str, tallya_reply: str) -> Dict:
+def db_add_to_chat_history(
+    session_id: str,
+    student_message: str,
+    tallya_reply: str,
+    now_iso: Optional[str] = None
+) -> Dict:
     """Add conversation turn to session history in DynamoDB"""
+    now = now_iso or _now_iso()
+    turn = {
+        "timestamp": now,
+        "student": student_message,
+        "tallya": tallya_reply
+    }
+    
+    # Append without reading the session while history is below the cap
+    try:
+        session_table.update_item(
+            Key={"session_id": session_id},
+            UpdateExpression="SET history=list_append(if_not_exists(history, :empty), :turn), updated_at=:u",
+            ConditionExpression="attribute_exists(session_id) AND "
+            "(attribute_not_exists(history) OR size(history) < :max)",
+            ExpressionAttributeValues={
+                ":empty": [],
+                ":turn": [turn],
+                ":u": now,
+                ":max": HISTORY_MAX_TURNS
+            }
+        )
+        return {"status": "history_updated"}
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    
+    # Session missing or history full: read, trim, and rewrite
     session = session_table.get_item(Key={"session_id": session_id}).get("Item")
     
     if not session:
         return {"error": "Session not found"}
     
     history = session.get("history", [])
-    history.append({
-        "timestamp": datetime.now(UTC).isoformat(),
-        "student": student_message,
-        "tallya": tallya_reply
-    })
+    history.append(turn)
     
     session_table.update_item(
         Key={"session_id": session_id},
         UpdateExpression="SET history=:h, updated_at=:u",
         ExpressionAttributeValues={
-            ":h": history[-20:],
-            ":u": datetime.now(UTC).isoformat()
+            ":h": history[-HISTORY_KEEP_TURNS:],
+            ":u": now
         }
     )
     return {"status": "history_updated"}
@@ -235,13 +350,12 @@ def generate_quiz_questions(session_id, topic: str, grade: int, num_questions: i
     Returns:
         List of question dictionaries with question, options, correct answer, and explanation
     """
+    # Agents keep conversation history, so each call gets a fresh one; the
+    # model and its Bedrock client are shared
     quiz_gen_agent = Agent(
         callback_handler=None,
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n"
-        "You are an expert at creating educational quiz questions. "
-        "Generate engaging, age-appropriate multiple-choice questions. "
-        "Each question must have exactly 4 options (A, B, C, D) with one correct answer."
+        model=_get_model(),
+        system_prompt=QUIZ_GEN_SYSTEM_PROMPT
     )
     
     prompt = f"""
@@ -269,8 +383,7 @@ def generate_quiz_questions(session_id, topic: str, grade: int, num_questions: i
       }}
     ]
     """
-    print(f"Generating Quiz Questions")
-    print("\n" + "="*50 + "\n")
+    logger.debug("Generating Quiz Questions")
     
     response = quiz_gen_agent(prompt)
     
@@ -282,14 +395,16 @@ def generate_quiz_questions(session_id, topic: str, grade: int, num_questions: i
         elif "```" in content:
             content = content.split("```")[1].split("```")[0].strip()
         
-        import re
-        json_match = re.search(r'\[.*?\]', content, re.DOTALL)
-        if json_match:
-            quiz_items = json.loads(json_match.group(0))
+        # Decode the first JSON array in place; brackets inside strings are handled
+        array_start = content.find("[")
+        if array_start != -1:
+            quiz_items, _ = _JSON_DECODER.raw_decode(content, array_start)
         else:
             quiz_items = json.loads(content)
-        db_save_quiz(session_id, quiz_items, topic, grade)
-        db_create_session(session_id, len(quiz_items), topic, grade)
+        # One timestamp for the whole quiz so its items and session agree
+        now_iso = _now_iso()
+        db_save_quiz(session_id, quiz_items, topic, grade, now_iso)
+        db_create_session(session_id, len(quiz_items), topic, grade, now_iso)
         return quiz_items
     
     except Exception as e:
@@ -319,19 +434,25 @@ def evaluate_answer(
     Returns:
         Dict with is_correct and normalized answers
     """
-    user_ans_normalized = user_answer.upper().strip()
-    correct_ans_normalized = correct_answer.upper().strip()
+    session = db_get_session(session_id)
+    if "error" in session:
+        return session
 
-    db_update_question_answer(session_id, q_index, user_answer, user_ans_normalized == correct_ans_normalized)
-                
-    # Update session progress
-    session_data = db_get_session(session_id)
-    new_score = session_data["score"] + (1 if user_ans_normalized == correct_ans_normalized else 0)
-    new_question = session_data["current_question"] + 1
-    new_state = "completed" if new_question >= session_data["total_questions"] else "in_progress"
-    
-    db_update_session_progress(session_id, score=new_score, current_question=new_question, state=new_state)
+    result = _check_answer(options, correct_answer, user_answer)
+
+    # Save the answer and update session progress in one transaction
+    db_record_answer(
+        session_id, q_index, user_answer, result["is_correct"],
+        session["current_question"], session["total_questions"]
+    )
     
+    return result
+
+
+def _check_answer(options: Dict, correct_answer: str, user_answer: str) -> Dict:
+    """Compare normalized answer letters"""
+    user_ans_normalized = user_answer.upper().strip()
+    correct_ans_normalized = correct_answer.upper().strip()
     return {
         "is_correct": user_ans_normalized == correct_ans_normalized,
         "user_answer": user_ans_normalized,
@@ -365,16 +486,75 @@ def generate_feedback(
     Returns:
         Personalized feedback string in Taglish
     """
-    feedback_agent = Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n"
-        "You specialize in giving encouraging, educational feedback. "
-        "Mix English and Filipino naturally. Be supportive and helpful."
-    )
+    logger.debug("Generating Feedback")
+
+    feedback = _feedback_agent()(_feedback_prompt(question, options, correct_answer, user_answer, is_correct, explanation))
+    return str(feedback)
+
+
+@tool
+async def submit_and_feedback(session_id: str, q_index: int, user_answer: str) -> Dict:
+    """
+    Check a student's answer, save it, and generate feedback in one step.
+    Saving the answer and generating the feedback run concurrently.
     
+    Args:
+        session_id: Session identifier
+        q_index: Index of the question being answered
+        user_answer: Student's answer letter
+    
+    Returns:
+        Dict with is_correct, normalized answers, choice texts, and feedback
+    """
+    question, session = await asyncio.gather(
+        asyncio.to_thread(db_get_question, session_id, q_index),
+        asyncio.to_thread(db_get_session, session_id),
+    )
+    if "error" in question:
+        return question
+    if "error" in session:
+        return session
+
+    result = _check_answer(question["options"], question["correct"], user_answer)
+    prompt = _feedback_prompt(
+        question["question"],
+        question["options"],
+        result["correct_answer"],
+        result["user_answer"],
+        result["is_correct"],
+        question["explanation"]
+    )
+
+    _, feedback = await asyncio.gather(
+        asyncio.to_thread(
+            db_record_answer, session_id, q_index, user_answer, result["is_correct"],
+            session["current_question"], session["total_questions"]
+        ),
+        _feedback_agent().invoke_async(prompt),
+    )
+    return {**result, "feedback": str(feedback)}
+
+
+def _feedback_agent() -> Agent:
+    """Create a feedback agent for a single answer"""
+    return Agent(
+        model=_get_model(),
+        system_prompt=FEEDBACK_SYSTEM_PROMPT
+    )
+
+
+def _feedback_prompt(
+    question: str,
+    options: Dict,
+    correct_answer: str,
+    user_answer: str,
+    is_correct: bool,
+    explanation: str
+) -> str:
+    """Build the feedback prompt for an answered question"""
     status = "CORRECT! 🎉" if is_correct else "Wrong 😞"
     
-    prompt = f"""
+    return f"""
     Give feedback for this answer:
     
     Question: {question}
@@ -392,11 +572,6 @@ def generate_feedback(
     Use Taglish naturally (mix English and Filipino).
     Be warm, supportive, and educational!
     """
-    print(f"Generating Feedback")
-    print("\n" + "="*50 + "\n")
-
-    feedback = feedback_agent(prompt)
-    return str(feedback)
 
 
 @tool
@@ -424,15 +599,11 @@ def generate_explanation(
         Detailed explanation string in Taglish
     """
 
-    print(f"Generating Explanation")
-    print("\n" + "="*50 + "\n")
+    logger.debug("Generating Explanation")
 
     explain_agent = Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n"
-        "You are an expert at explaining complex concepts simply. "
-        "Break things down step-by-step for K-12 students. "
-        "Use examples, analogies, and mnemonics."
+        model=_get_model(),
+        system_prompt=EXPLAIN_SYSTEM_PROMPT
     )
     
     prompt = f"""
@@ -459,6 +630,15 @@ def generate_explanation(
     return str(explanation)
 
 
+def _format_turn(turn) -> str:
+    """Render one chat history turn compactly for a prompt"""
+    if isinstance(turn, dict) and ("student" in turn or "tallya" in turn):
+        return f"- Student: {turn.get('student', '')} | Tallya: {turn.get('tallya', '')}"
+    if isinstance(turn, dict):
+        return "- " + ", ".join(f"{k}: {v}" for k, v in turn.items())
+    return f"- {turn}"
+
+
 @tool
 def generate_chat_response(
     session_id,
@@ -479,14 +659,13 @@ def generate_chat_response(
         Contextual response from Tallya in Taglish
     """
     chat_agent = Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n"
-        "You maintain conversational context and respond naturally to student messages. "
-        "Reference their quiz progress and previous interactions when relevant."
+        model=_get_model(),
+        system_prompt=CHAT_SYSTEM_PROMPT
     )
     
-    progress_str = json.dumps(current_progress, indent=2)
-    history_str = json.dumps(chat_history[-5:], indent=2, ensure_ascii=False) if chat_history else "[]"
+    # Plain "key: value" lines use far fewer tokens than indented JSON
+    progress_str = ", ".join(f"{k}: {v}" for k, v in current_progress.items())
+    history_str = "\n    ".join(_format_turn(turn) for turn in chat_history[-5:]) if chat_history else "(none)"
     
     prompt = f"""
     Respond naturally to the student's message.
@@ -509,52 +688,61 @@ def generate_chat_response(
     Just respond naturally - be conversational!
     """
 
-    print(f"Generating Chat Response")
-    print("\n" + "="*50 + "\n")
+    logger.debug("Generating Chat Response")
     
     response = chat_agent(prompt)
     db_add_to_chat_history(session_id, student_message, response)
     return str(response)
 
+# Orchestrator configuration is fixed, so it is built once at import
+ORCHESTRATOR_SYSTEM_PROMPT = (
+    f"{BASE_PERSONA}\n\n"
+    "You are the MASTER ORCHESTRATOR of the Tallya Quiz System.\n"
+    "Your role is to analyze user requests and decide what actions to take.\n\n"
+    "AVAILABLE TOOLS:\n"
+    "- generate_quiz_questions: Create quiz content\n"
+    "- db_get_question: To get more context of the question, answer, and explanation\n"
+    "- evaluate_answer: Check if an answer is correct\n"
+    "- submit_and_feedback: Check and save an answer and create feedback in one step\n"
+    "- get_curriculum_context: This calls curriculum agent, needed whenever there is query about curriculums. Always use this before quiz generation.\n"
+    "- generate_feedback: Create personalized feedback\n"
+    "- generate_explanation: Provide detailed explanations\n"
+    "- generate_chat_response: Create contextual chat responses\n\n"
+    "YOUR WORKFLOW:\n"
+    "1. Analyze the user's request\n"
+    "2. Determine the action needed (quiz generation, answer checking, explanation, chat, status)\n"
+    "3. Call the appropriate tools\n"
+    "4. Return a complete, structured response\n\n"
+    "COMMON WORKFLOWS:\n"
+    "- Quiz Generation: Use get_curriculum_context → generate_quiz_questions → only show the questions DO NOT SHOW answers and explanation Use double line spacing\n"
+    "- Answer Submission: Use submit_and_feedback\n"
+    "- Explanation Request: Use db_get_question → generate_explanation\n"
+    "- Chat: Use db_get_session → generate_chat_response\n"
+    "- Status Check: Use db_get_session → Return progress from input data\n\n"
+    "BE INTELLIGENT: Understand context, infer intent, and provide complete solutions.\n"
+    "ALWAYS use tools to generate content - don't make up data without calling tools first!\n"
+    "Use natural conversation with headers and with proper line spacing (double line space before a header) as your final response."
+    "For quiz generation, make the questions as headers"
+)
+
+ORCHESTRATOR_TOOLS = (
+    generate_quiz_questions,
+    evaluate_answer,
+    submit_and_feedback,
+    generate_feedback,
+    generate_explanation,
+    generate_chat_response,
+    get_curriculum_context,
+    db_get_question,
+    db_get_session,
+)
+
 def create_orchestrator() -> Agent:
+    # Agents keep per-conversation message state, so only the model is shared
     return Agent(
-        model=modelWithGuardrail,
-        system_prompt=f"{BASE_PERSONA}\n\n"
-        "You are the MASTER ORCHESTRATOR of the Tallya Quiz System.\n"
-        "Your role is to analyze user requests and decide what actions to take.\n\n"
-        "AVAILABLE TOOLS:\n"
-        "- generate_quiz_questions: Create quiz content\n"
-        "- db_get_question: To get more context of the question, answer, and explanation\n"
-        "- evaluate_answer: Check if an answer is correct\n"
-        "- get_curriculum_context: This calls curriculum agent, needed whenever there is query about curriculums. Always use this before quiz generation.\n"
-        "- generate_feedback: Create personalized feedback\n"
-        "- generate_explanation: Provide detailed explanations\n"
-        "- generate_chat_response: Create contextual chat responses\n\n"
-        "YOUR WORKFLOW:\n"
-        "1. Analyze the user's request\n"
-        "2. Determine the action needed (quiz generation, answer checking, explanation, chat, status)\n"
-        "3. Call the appropriate tools\n"
-        "4. Return a complete, structured response\n\n"
-        "COMMON WORKFLOWS:\n"
-        "- Quiz Generation: Use get_curriculum_context → generate_quiz_questions → only show the questions DO NOT SHOW answers and explanation Use double line spacing\n"
-        "- Answer Submission: Use db_get_question → evaluate_answer → generate_feedback\n"
-        "- Explanation Request: Use db_get_question → generate_explanation\n"
-        "- Chat: Use db_get_session → generate_chat_response\n"
-        "- Status Check: Use db_get_session → Return progress from input data\n\n"
-        "BE INTELLIGENT: Understand context, infer intent, and provide complete solutions.\n"
-        "ALWAYS use tools to generate content - don't make up data without calling tools first!\n"
-        "Use natural conversation with headers and with proper line spacing (double line space before a header) as your final response."
-        "For quiz generation, make the questions as headers",
-        tools=[
-            generate_quiz_questions,
-            evaluate_answer,
-            generate_feedback,
-            generate_explanation,
-            generate_chat_response,
-            get_curriculum_context,
-            db_get_question,
-            db_get_session,
-        ],
+        model=_get_model(),
+        system_prompt=ORCHESTRATOR_SYSTEM_PROMPT,
+        tools=ORCHESTRATOR_TOOLS,
     )
 
 async def stream_async(payload):
@@ -562,245 +750,24 @@ async def stream_async(payload):
     user_prompt = payload.get("user_input", payload.get("message", ""))
     file_input = payload.get("file_input", None)
     session_id = payload.get("session_id")
-    user_prompt = build_message_with_context(session_id, user_prompt)
+    # Chat history is read from DynamoDB; keep the event loop free meanwhile
+    user_prompt = await asyncio.to_thread(build_message_with_context, session_id, user_prompt)
     
     # If file is uploaded, include file info in prompt
     if file_input and file_input.file_name:
         user_prompt = f"[Document attached: {file_input.file_name}]\n\n{user_prompt}"
     tallya = create_orchestrator()
 
-    logger.info(f"QUIZZER AGENT CALLED")
-
-    buffer = ""
-    inside_thinking = False
-
-    async for chunk in tallya.stream_async(user_prompt):
-        if "data" in chunk:
-            data = chunk["data"]
-            buffer += data
-            
-            # Process buffer for complete tags
-            while True:
-                if not inside_thinking:
-                    # Look for opening tag
-                    start = buffer.lower().find('<thinking>')
-                    if start != -1:
-                        # Yield everything before tag, converting newlines
-                        if start > 0:
-                            yield buffer[:start].replace('\n', '<br>')
-                        buffer = buffer[start + 10:]
-                        inside_thinking = True
-                    else:
-                        # Check if buffer might contain partial opening tag
-                        safe_end = len(buffer)
-                        for i in range(min(10, len(buffer)), 0, -1):
-                            if buffer[-i:].lower() == '<thinking>'[:i]:
-                                safe_end = len(buffer) - i
-                                break
-                        
-                        # Yield safe content with newlines converted to <br>
-                        if safe_end > 0:
-                            yield buffer[:safe_end].replace('\n', '<br>')
-                            buffer = buffer[safe_end:]
-                        break
-                else:
-                    # Look for closing tag
-                    end = buffer.lower().find('</thinking>')
-                    if end != -1:
-                        buffer = buffer[end + 11:]
-                        inside_thinking = False
-                    else:
-                        if len(buffer) > 11:
-                            for i in range(min(11, len(buffer)), 0, -1):
-                                if buffer[-i:].lower() == '</thinking>'[:i]:
-                                    buffer = buffer[-(i):]
-                                    break
-                            else:
-                                buffer = buffer[-11:]
-                        break
-
-    # Flush remaining buffer with newlines converted
-    if buffer and not inside_thinking:
-        yield buffer.replace('\n', '<br>')
-
-        # if hasattr(chunk, "text"):
-        #     yield chunk.text
-        # else:
-        #     yield str(chunk)
-        # if "data" in chunk:
-        #     data = chunk["data"]
-        #     thinking_parts = ["<", "<t", "<th", "<thi", "<thin", "<think", "<thinki", "<thinkin", "<thinking", "<thinking>", 
-        #                      "</", "</t", "</th", "</thi", "</thin", "</think", "</thinki", "</thinkin", "</thinking", "</thinking>"]
-        #     if not any(part in data.lower() for part in thinking_parts):
-        #         yield data
-        # else:
-        #     yield str(chunk)
-
-# async def handle(body):
-#     """
-#     AWS Lambda entry point
-#     - Orchestrator handles business logic
-#     - Separate database operations
-#     """
-
-#     orchestrator = create_orchestrator()
-
-#     # orchestrator = Agent(
-#     #     # callback_handler=None,
-#     #     model=modelWithGuardrail,
-#     #     system_prompt=f"{BASE_PERSONA}\n\n"
-#     #     "You are the MASTER ORCHESTRATOR of the Tallya Quiz System.\n"
-#     #     "Your role is to analyze user requests and decide what actions to take.\n\n"
-        
-#     #     "AVAILABLE TOOLS:\n"
-#     #     "- generate_quiz_questions: Create quiz content\n"
-#     #     "- db_get_question: To get more context of the question, answer, and explanation\n"
-#     #     "- evaluate_answer: Check if an answer is correct\n"
-#     #     "- generate_feedback: Create personalized feedback\n"
-#     #     "- generate_explanation: Provide detailed explanations\n"
-#     #     "- generate_chat_response: Create contextual chat responses\n\n"
-        
-#     #     "YOUR WORKFLOW:\n"
-#     #     "1. Analyze the user's request\n"
-#     #     "2. Determine the action needed (quiz generation, answer checking, explanation, chat, status)\n"
-#     #     "3. Call the appropriate tools\n"
-#     #     "4. Return a complete, structured response\n\n"
-        
-#     #     "COMMON WORKFLOWS:\n"
-#     #     "- Quiz Generation: Use generate_quiz_questions\n"
-#     #     "- Answer Submission: Use db_get_question → evaluate_answer → generate_feedback\n"
-#     #     "- Explanation Request: Use db_get_question → generate_explanation\n"
-#     #     "- Chat: Use db_get_session → generate_chat_response\n"
-#     #     "- Status Check: Use db_get_session → Return progress from input data\n\n"
-        
-#     #     "BE INTELLIGENT: Understand context, infer intent, and provide complete solutions.\n"
-#     #     "ALWAYS use tools to generate content - don't make up data without calling tools first!\n"
-#     #     "Return your final response as a clean JSON object.",
-        
-#     #     tools=[
-#     #         generate_quiz_questions,
-#     #         evaluate_answer,
-#     #         generate_feedback,
-#     #         generate_explanation,
-#     #         generate_chat_response,
-#     #         db_get_question,
-#     #         db_get_session
-#     #     ]
-#     # )
-    
-#     try:
-        
-#         # Generate session ID if not provided
-#         session_id = body.get("session_id", f"session-{datetime.now(UTC).strftime('%Y%m%d%H%M%S')}")
-        
-#         # Add session_id to body if not present
-#         if "session_id" not in body:
-#             body["session_id"] = session_id
-        
-#         # Create a natural language request for the orchestrator
-#         request_prompt = f"""
-#         USER REQUEST:
-#         {json.dumps(body, indent=2, ensure_ascii=False)}
-        
-#         SESSION_ID: {session_id}
-#         TIMESTAMP: {datetime.now(UTC).isoformat()}
-        
-#         Analyze this request and determine what the user wants:
-#         - If they mention "quiz", "generate", "create", "start": Generate quiz content
-#         - If they mention "answer", "submit", "check": Evaluate their answer
-#         - If they mention "explain", "help", "understand": Provide explanation
-#         - If they mention "chat", "talk", "hello": Respond conversationally
-#         - If they mention "status", "progress": Return their progress
-        
-#         Call the appropriate tools and return a complete response.
-#         """
-
-#         # Stream from the model
-#         streamed_text = ""
-#         async for chunk in orchestrator.stream_async(request_prompt):
-#             text_chunk = str(chunk)
-#             streamed_text += text_chunk
-#             yield text_chunk  # Send to WebSocket in real time
-
-#         # 🧩 Once streaming completes, parse JSON content from full text
-#         # try:
-#         #     response_text = streamed_text.strip()
-#         #     if "```json" in response_text:
-#         #         json_content = response_text.split("```json")[1].split("```")[0].strip()
-#         #     elif "{" in response_text and "}" in response_text:
-#         #         import re
-#         #         json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
-#         #         json_content = json_match.group(0) if json_match else "{}"
-#         #     else:
-#         #         json_content = "{}"
-
-#         #     final_json = json.loads(json_content)
-#         # except Exception:
-#         #     final_json = {"session_id": session_id, "response": streamed_text, "status": "completed"}
-
-#         # # Yield final structured result
-#         # yield json.dumps({"type": "final", "data": final_json})
-
-#         if "```json" in response_text:
-#             json_content = response_text.split("```json")[1].split("```")[0].strip()
-#         elif "{" in response_text and "}" in response_text:
-#             import re
-#             json_match = re.search(r"\{.*\}", response_text, re.DOTALL)
-#             json_content = json_match.group(0) if json_match else "{}"
-#         else:
-#             json_content = "{}"
-
-#         final_json = json.loads(json_content)
-#         yield json.dumps({"type": "final", "data": final_json})
-
-#     except Exception as exc:
-#         import traceback
-
-#         error_payload = {
-#             "type": type(exc).__name__,
-#             "message": str(exc),
-#             "traceback": traceback.format_exc(),
-#             "session_id": body.get("session_id"),
-#         }
-
-#         yield json.dumps({"type": "error", "data": error_payload})
-#         raise
-        
-#     #     # Let the orchestrator decide and execute
-#     #     orchestrator_response = orchestrator(request_prompt)
-        
-#     #     # Parse orchestrator's response
-#     #     try:
-#     #         response_text = str(orchestrator_response)
-            
-#     #         # Extract JSON from response
-#     #         if "```json" in response_text:
-#     #             json_content = response_text.split("```json")[1].split("```")[0].strip()
-#     #         elif "```" in response_text:
-#     #             json_content = response_text.split("```")[1].split("```")[0].strip()
-#     #         elif "{" in response_text and "}" in response_text:
-#     #             import re
-#     #             json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-#     #             json_content = json_match.group(0) if json_match else response_text
-#     #         else:
-#     #             json_content = response_text
-            
-#     #         result = json.loads(json_content)
-#     #     except:
-#     #         result = {
-#     #             "session_id": session_id,
-#     #             "response": str(orchestrator_response),
-#     #             "status": "completed"
-#     #         }
-    
-#     # except Exception as e:
-#     #     import traceback
-#     #     return {
-#     #         "statusCode": 500,
-#     #         "body": json.dumps({
-#     #             "error": str(e),
-#     #             "type": type(e).__name__,
-#     #             "traceback": traceback.format_exc()
-#     #         })
-#     #     }
+    logger.debug("QUIZZER AGENT CALLED")
 
+    # Repeated db_get_question calls within this request share one read. The
+    # generator may be finalized in another context, so the variable is never
+    # reset; emptying the request's own dict is enough to drop its entries
+    memo: Dict = {}
+    _question_memo.set(memo)
+    try:
+        async for text in strip_thinking(tallya.stream_async(user_prompt)):
+            # Newlines are sent as <br> for the chat client
+            yield text.replace('\n', '<br>')
+    finally:
+        memo.clear()
@@ -4,15 +4,19 @@ import sys
 sys.path.append('..')
 from chat_context import build_message_with_context
 import boto3
+from boto3.s3.transfer import TransferConfig
 import json
-import os, re, traceback
+import asyncio
+import html, os, re, tempfile, traceback
 from datetime import datetime
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, ListFlowable, ListItem
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from agents.utils.reviewer_utils import get_outline_and_notes
+from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY
+from agents.utils.reviewer_utils import KB_MISS_RE, get_outline_and_notes, aget_outline_and_notes
 from agents.curriculum_agent import get_curriculum_context
+from agents.utils.stream_utils import strip_thinking
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,18 +26,93 @@ CONFIG_PATH = "agents/config/review_config.json"
 with open(CONFIG_PATH, "r") as f:
     config = json.load(f)
 
+# Module-scoped so PDF uploads reuse one client and its connection pool
+s3_client = boto3.client("s3", region_name=config["aws_region"])
+
+# Large reviewers go up as parallel 8 MiB parts; smaller ones in a single PUT
+PDF_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=True,
+)
+
+# PDFs larger than this spill from memory to an anonymous temp file while building
+PDF_SPOOL_MAX_SIZE = 2 * 1024 * 1024
+
+# PDF styles are built once and only read while rendering
+_SAMPLE_STYLES = getSampleStyleSheet()
+TITLE_STYLE = ParagraphStyle('Title', parent=_SAMPLE_STYLES['Title'],
+                             fontSize=18, spaceAfter=12, alignment=TA_CENTER)
+HEADER_STYLE = ParagraphStyle('Header', parent=_SAMPLE_STYLES['Heading2'],
+                              fontSize=13, spaceBefore=10, spaceAfter=6, textColor='#003366')
+BODY_STYLE = ParagraphStyle('Body', parent=_SAMPLE_STYLES['Normal'],
+                            fontSize=11, leading=15, alignment=TA_JUSTIFY)
+META_STYLE = ParagraphStyle('Meta', parent=_SAMPLE_STYLES['Normal'],
+                            fontSize=10, spaceAfter=4, textColor='#555555')
+
+# One pass over the reviewer text finds and classifies every section heading
+_SECTION_RE = re.compile(
+    r"(?P<lesson>📘 Reviewer Lesson:)|(?P<overview>Lesson Overview:)|(?P<objectives>Learning Objectives:)"
+    r"|(?P<concepts>Key Concepts and Explanations:)|(?P<apps>Application or Examples:)"
+    r"|(?P<tips>Memory Tips:)|(?P<recap>Quick Recap:)"
+)
+
+def _iter_sections(text: str):
+    """Yield (heading group, body) per section; the group is None for text before the first heading"""
+    matches = list(_SECTION_RE.finditer(text))
+    preamble = text[:matches[0].start()] if matches else text
+    if preamble.strip():
+        yield None, preamble
+    for match, following in zip(matches, matches[1:] + [None]):
+        yield match.lastgroup, text[match.end():following.start() if following else len(text)]
+
+def _bullet_lines(body: str) -> list:
+    """Non-empty lines of a section body with list markers removed, escaped for ReportLab"""
+    return [html.escape(line.strip("-• "), quote=False) for line in body.split("\n") if line.strip()]
+
+def _emit_overview(body: str, story: list):
+    story.append(Paragraph("Lesson Overview", HEADER_STYLE))
+    story.append(Paragraph(html.escape(body.strip(), quote=False), BODY_STYLE))
+
+def _emit_concepts(body: str, story: list):
+    story.append(Paragraph("Key Concepts and Explanations", HEADER_STYLE))
+    for st in body.split("🔹")[1:]:
+        st = st.strip()
+        if ":" in st:
+            title, desc = st.split(":", 1)
+            story.append(Paragraph(f"<b>{html.escape(title.strip(), quote=False)}:</b>", BODY_STYLE))
+            story.append(Paragraph(html.escape(desc.strip(), quote=False), BODY_STYLE))
+            story.append(Spacer(1, 0.05 * inch))
+
+def _bullet_section(heading: str):
+    def emit(body: str, story: list):
+        # One ListFlowable per section rather than a Paragraph per bullet
+        story.append(Paragraph(heading, HEADER_STYLE))
+        story.append(ListFlowable(
+            [ListItem(Paragraph(line, BODY_STYLE)) for line in _bullet_lines(body)],
+            bulletType='bullet', leftIndent=20
+        ))
+    return emit
+
+# _SECTION_RE group -> PDF emitter; the "📘 Reviewer Lesson" banner has none and is skipped
+_SECTION_HANDLERS = {
+    "overview": _emit_overview,
+    "objectives": _bullet_section("Learning Objectives"),
+    "concepts": _emit_concepts,
+    "apps": _bullet_section("Application or Examples"),
+    "tips": _bullet_section("Memory Tips"),
+    "recap": _bullet_section("Quick Recap"),
+}
+
 @tool
 def generate_pdf(query: str) -> str:
     """
-    Generate a well-formatted DepEd-style reviewer PDF entirely in memory,
-    then upload it directly to S3 (no local file stored).
+    Generate a well-formatted DepEd-style reviewer PDF in memory (spilling to an
+    unnamed temp file only when large), then upload it directly to S3.
     Upload path: s3://kaisa-temp-bucket/public/
     """
     try:
-        from io import BytesIO
-
         # === Step 0: AWS S3 Setup ===
-        s3 = boto3.client("s3", region_name=config["aws_region"])
         bucket_name = "kaisa-temp-bucket"
 
         # === Step 1: Retrieve reviewer notes ===
@@ -49,85 +128,24 @@ def generate_pdf(query: str) -> str:
         s3_key = f"public/{filename}"  # ✅ Save inside /public/ folder
 
         # === Step 3: Generate PDF in memory ===
-        pdf_buffer = BytesIO()
+        pdf_buffer = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_MAX_SIZE)
         doc = SimpleDocTemplate(pdf_buffer, pagesize=letter,
                                 rightMargin=72, leftMargin=72,
                                 topMargin=72, bottomMargin=72)
 
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle('Title', parent=styles['Title'],
-                                     fontSize=18, spaceAfter=12, alignment=TA_CENTER)
-        header_style = ParagraphStyle('Header', parent=styles['Heading2'],
-                                      fontSize=13, spaceBefore=10, spaceAfter=6, textColor='#003366')
-        body_style = ParagraphStyle('Body', parent=styles['Normal'],
-                                    fontSize=11, leading=15, alignment=TA_JUSTIFY)
-        bullet_style = ParagraphStyle('Bullet', parent=styles['Normal'],
-                                      fontSize=11, leftIndent=20, leading=15, bulletIndent=10)
-        meta_style = ParagraphStyle('Meta', parent=styles['Normal'],
-                                    fontSize=10, spaceAfter=4, textColor='#555555')
-
         story = [
-            Paragraph("STUDY REVIEW NOTES", title_style),
-            Paragraph(f"Topic: <b>{query}</b>", meta_style),
-            Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", meta_style),
+            Paragraph("STUDY REVIEW NOTES", TITLE_STYLE),
+            Paragraph(f"Topic: <b>{html.escape(query, quote=False)}</b>", META_STYLE),
+            Paragraph(f"Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", META_STYLE),
             Spacer(1, 0.25 * inch)
         ]
 
-        sections = re.split(
-            r"(?=📘 Reviewer Lesson:|Lesson Overview:|Learning Objectives:|Key Concepts and Explanations:|Application or Examples:|Memory Tips:|Quick Recap:)",
-            text
-        )
-
-        for sec in sections:
-            sec = sec.strip()
-            if not sec:
-                continue
-
-            if re.match(r"Lesson Overview:", sec):
-                story.append(Paragraph("Lesson Overview", header_style))
-                story.append(Paragraph(re.sub(r"Lesson Overview:\s*", "", sec).strip(), body_style))
-
-            elif re.match(r"Learning Objectives:", sec):
-                story.append(Paragraph("Learning Objectives", header_style))
-                content = re.sub(r"Learning Objectives:\s*", "", sec).strip()
-                bullets = [obj.strip("-• ") for obj in content.split("\n") if obj.strip()]
-                story.append(ListFlowable(
-                    [ListItem(Paragraph(b, body_style)) for b in bullets],
-                    bulletType='bullet', leftIndent=20
-                ))
-
-            elif re.match(r"Key Concepts and Explanations:", sec):
-                story.append(Paragraph("Key Concepts and Explanations", header_style))
-                subtopics = re.split(r"🔹", sec)
-                for st in subtopics[1:]:
-                    st = st.strip()
-                    if ":" in st:
-                        title, desc = st.split(":", 1)
-                        story.append(Paragraph(f"<b>{title.strip()}:</b>", body_style))
-                        story.append(Paragraph(desc.strip(), body_style))
-                        story.append(Spacer(1, 0.05 * inch))
-
-            elif re.match(r"Application or Examples:", sec):
-                story.append(Paragraph("Application or Examples", header_style))
-                examples = [e.strip("-• ") for e in sec.split("\n") if e.strip() and not e.startswith("Application")]
-                for e in examples:
-                    story.append(Paragraph(f"• {e}", bullet_style))
-
-            elif re.match(r"Memory Tips:", sec):
-                story.append(Paragraph("Memory Tips", header_style))
-                tips = [t.strip("-• ") for t in sec.split("\n") if t.strip() and not t.startswith("Memory Tips")]
-                for t in tips:
-                    story.append(Paragraph(f"• {t}", bullet_style))
-
-            elif re.match(r"Quick Recap:", sec):
-                story.append(Paragraph("Quick Recap", header_style))
-                recaps = [r.strip("-• ") for r in sec.split("\n") if r.strip() and not r.startswith("Quick Recap")]
-                for r in recaps:
-                    story.append(Paragraph(f"• {r}", bullet_style))
-
-            else:
-                if not sec.lower().startswith("📘 reviewer lesson"):
-                    story.append(Paragraph(sec, body_style))
+        for group, body in _iter_sections(text):
+            handler = _SECTION_HANDLERS.get(group)
+            if handler:
+                handler(body, story)
+            elif group is None:
+                story.append(Paragraph(html.escape(body.strip(), quote=False), BODY_STYLE))
 
             story.append(Spacer(1, 0.15 * inch))
 
@@ -135,12 +153,15 @@ def generate_pdf(query: str) -> str:
         pdf_buffer.seek(0)
 
         # === Step 4: Upload to S3/public directly ===
-        s3.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=pdf_buffer.getvalue(),   # ✅ FIXED: convert to bytes
-            ContentType='application/pdf'
+        # Streams from the buffer instead of copying it out with getvalue()
+        s3_client.upload_fileobj(
+            pdf_buffer,
+            bucket_name,
+            s3_key,
+            ExtraArgs={"ContentType": "application/pdf"},
+            Config=PDF_TRANSFER_CONFIG
         )
+        pdf_buffer.close()
 
         public_url = f"https://{bucket_name}.s3.amazonaws.com/{s3_key}"
 
@@ -154,33 +175,29 @@ def generate_pdf(query: str) -> str:
         return f"❌ PDF generation or upload failed: {str(e)}\n\n{traceback.format_exc()}"
 
 @tool
-def generate_outline_and_notes(query: str):
+async def generate_outline_and_notes(query: str):
     """Fetch reviewer notes and outline from Knowledge Base."""
-    raw_notes = get_outline_and_notes(query, isPDF="false", mode="plain")
+    # The agent narrates the lesson itself, so skip the extra reviewer generation
+    raw_notes = await aget_outline_and_notes(query, isPDF="false", mode="plain", outline=False)
 
     # Normalized detection for KB misses
-    if raw_notes == "__KB_MISSING__" or any(phrase in raw_notes for phrase in [
-        "don’t have that in my reviewer",
-        "don't have that in my reviewer",
-        "Hmm, looks like I don’t have that",
-        "Hmm, looks like I don't have that",
-        "Reviewer JSON parse failed"
-    ]):
+    if raw_notes == "__KB_MISSING__" or KB_MISS_RE.search(raw_notes):
         return "__KB_MISSING__"
 
     return raw_notes
 
 async def stream_async(payload):
     """Async generator that yields streamed model output."""
-    logger.info(f"REVIEWER CALLED")
+    logger.debug("REVIEWER CALLED")
     user_prompt = payload.get("user_input", payload.get("message", ""))
     file_input = payload.get("file_input", None)
     session_id = payload.get("session_id")
-    user_prompt = build_message_with_context(session_id, user_prompt)
-    
-    # If file is uploaded, include file info in prompt
-    if file_input and file_input.file_name:
-        user_prompt = f"[Document attached: {file_input.file_name}]\n\n{user_prompt}"
+
+    # Fetch chat history on a worker thread while the model and agent are built
+    context_task = asyncio.create_task(
+        asyncio.to_thread(build_message_with_context, session_id, user_prompt)
+    )
+
     # Create an agent
     modelWithGuardrail = BedrockModel(
         model_id=config['bedrock']['model_id'],
@@ -256,58 +273,11 @@ async def stream_async(payload):
         """
     )
 
-    buffer = ""
-    inside_thinking = False
+    user_prompt = await context_task
 
-    async for chunk in reviewer_agent.stream_async(user_prompt):
-        if "data" in chunk:
-            data = chunk["data"]
-            buffer += data
-            
-            # Process buffer for complete tags
-            while True:
-                if not inside_thinking:
-                    # Look for opening tag
-                    start = buffer.lower().find('<thinking>')
-                    if start != -1:
-                        # Yield everything before tag
-                        if start > 0:
-                            yield buffer[:start]
-                        buffer = buffer[start + 10:]  # Remove '<thinking>'
-                        inside_thinking = True
-                    else:
-                        # Check if buffer might contain partial opening tag
-                        safe_end = len(buffer)
-                        for i in range(min(10, len(buffer)), 0, -1):
-                            if buffer[-i:].lower() == '<thinking>'[:i]:
-                                safe_end = len(buffer) - i
-                                break
-                        
-                        # Yield safe content
-                        if safe_end > 0:
-                            yield buffer[:safe_end]
-                            buffer = buffer[safe_end:]
-                        break
-                else:
-                    # Look for closing tag
-                    end = buffer.lower().find('</thinking>')
-                    if end != -1:
-                        # Discard thinking content and remove closing tag
-                        buffer = buffer[end + 11:]  # Remove '</thinking>'
-                        inside_thinking = False
-                    else:
-                        # Check if buffer might contain partial closing tag
-                        if len(buffer) > 11:
-                            # Keep only enough to detect partial tag
-                            for i in range(min(11, len(buffer)), 0, -1):
-                                if buffer[-i:].lower() == '</thinking>'[:i]:
-                                    buffer = buffer[-(i):]
-                                    break
-                            else:
-                                # No partial match, discard all but last 11 chars
-                                buffer = buffer[-11:]
-                        break
-
-    # Flush remaining buffer (only if not inside thinking block)
-    if buffer and not inside_thinking:
-        yield buffer
+    # If file is uploaded, include file info in prompt
+    if file_input and file_input.file_name:
+        user_prompt = f"[Document attached: {file_input.file_name}]\n\n{user_prompt}"
+
+    async for text in strip_thinking(reviewer_agent.stream_async(user_prompt)):
+        yield text
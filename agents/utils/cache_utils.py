@@ -0,0 +1,169 @@
+import math
+import operator
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Sequence
+
+
+def _unit(vector: Sequence[float]) -> tuple:
+    """Scale vector to unit length so cosine similarity is a plain dot product"""
+    norm = math.sqrt(sum(x * x for x in vector))
+    if not norm:
+        return tuple(vector)
+    return tuple(x / norm for x in vector)
+
+
+def normalize_query(text: str) -> str:
+    """Case- and whitespace-insensitive form of a query, used for exact hits"""
+    return " ".join(text.lower().split())
+
+
+class SemanticCache:
+    """
+    In-memory semantic cache keyed on query embeddings.
+
+    Entries are grouped by namespace (e.g. session + knowledge base id + result
+    count) so lookups never cross sessions or unrelated retrieval settings.
+    get_exact() answers repeated queries without an embedding call; lookup()
+    then compares the query embedding against at most max_scan of the
+    namespace's most recent entries and returns the best match whose cosine
+    similarity reaches the threshold. Eviction is least-recently-used across
+    all namespaces.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[str], Sequence[float]],
+        threshold: float = 0.9,
+        ttl_seconds: float = 3600,
+        max_entries: int = 256,
+        max_scan: int = 32,
+    ):
+        self._embed_fn = embed_fn
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_scan = max_scan
+        # (namespace, normalized query) -> (unit vector, value, stored_at), in LRU order
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # namespace -> its normalized queries, oldest first
+        self._namespaces: "dict[Hashable, OrderedDict[str, None]]" = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float, now: float) -> bool:
+        return bool(self.ttl_seconds) and now - stored_at > self.ttl_seconds
+
+    def _remove(self, key: tuple) -> None:
+        # Caller holds the lock
+        del self._entries[key]
+        namespace, query = key
+        queries = self._namespaces[namespace]
+        del queries[query]
+        if not queries:
+            del self._namespaces[namespace]
+
+    def embed(self, text: str) -> Sequence[float]:
+        return self._embed_fn(text)
+
+    def get_exact(self, namespace: Hashable, query: str) -> Optional[str]:
+        """Return the cached value for the same normalized query, or None"""
+        key = (namespace, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if self._expired(entry[2], time.monotonic()):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def lookup(self, namespace: Hashable, vector: Sequence[float]) -> Optional[str]:
+        """Return the cached value for the closest recent match in namespace, or None"""
+        now = time.monotonic()
+        with self._lock:
+            queries = self._namespaces.get(namespace)
+            if not queries:
+                return None
+            candidates = []
+            for query in reversed(queries):
+                if len(candidates) >= self.max_scan:
+                    break
+                candidates.append((query, self._entries[(namespace, query)]))
+
+        # Similarity is computed outside the lock; stored vectors are unit length
+        query_vector = _unit(vector)
+        best_query = None
+        best_score = self.threshold
+        for query, (entry_vector, _, stored_at) in candidates:
+            if self._expired(stored_at, now):
+                continue
+            score = sum(map(operator.mul, query_vector, entry_vector))
+            if score >= best_score:
+                best_query, best_score = query, score
+
+        if best_query is None:
+            return None
+
+        key = (namespace, best_query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def store(self, namespace: Hashable, query: str, vector: Sequence[float], value: str) -> None:
+        key = (namespace, normalize_query(query))
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (_unit(vector), value, time.monotonic())
+            self._namespaces.setdefault(namespace, OrderedDict())[key[1]] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._namespaces.clear()
+
+
+class TTLCache:
+    """
+    Thread-safe exact-key cache with expiry.
+
+    Entries older than ttl_seconds are treated as missing. Eviction is
+    least-recently-used once max_entries is exceeded.
+    """
+
+    def __init__(self, ttl_seconds: float = 600, max_entries: int = 512):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key, or None if missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl_seconds and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def store(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
@@ -1,23 +1,66 @@
 import boto3, os, html, traceback, json, re
+import asyncio
 from datetime import datetime
+from functools import lru_cache
+from agents.utils.cache_utils import TTLCache
 
-def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly") -> str:
-    """
-    Retrieve topic content from the Knowledge Base and generate a full reviewer outline
-    with expanded explanations per subtopic. Produces detailed, readable study material.
-    """
+CONFIG_PATH = "config.json"
 
-    CONFIG_PATH = "config.json"
+@lru_cache(maxsize=1)
+def _load_config() -> dict:
+    """Read the shared configuration on first use"""
     with open(CONFIG_PATH, "r") as f:
-        config = json.load(f)
+        return json.load(f)
 
+@lru_cache(maxsize=1)
+def _kb_settings() -> tuple[str, str]:
+    """Knowledge base id and model ARN, with environment overrides"""
+    config = _load_config()
     kb_id = os.getenv("BEDROCK_KB_ID", config['kb']['id'])
     kb_model_arn = os.getenv("BEDROCK_MODEL_ARN", config['kb']['model_embed'])
+    return kb_id, kb_model_arn
+
+# Bedrock clients are created once per process and reused by every call
+@lru_cache(maxsize=1)
+def _bedrock_agent_client():
+    return boto3.client("bedrock-agent-runtime", region_name=_load_config()['aws_region'])
+
+@lru_cache(maxsize=1)
+def _bedrock_runtime_client():
+    return boto3.client("bedrock-runtime", region_name=_load_config()['aws_region'])
+
+# Finished reviewer text keyed by (normalized query, isPDF, mode), so the same topic
+# asked again within the TTL skips both Bedrock calls
+outline_cache = TTLCache(
+    ttl_seconds=float(os.getenv("OUTLINE_CACHE_TTL", 600)),
+    max_entries=int(os.getenv("OUTLINE_CACHE_MAX_ENTRIES", 512)),
+)
+
+# Phrases that mean the KB had nothing for the topic (straight or curly apostrophe)
+KB_MISS_RE = re.compile(r"don['’]t have that in my reviewer|Hmm, looks like I don['’]t have that|Reviewer JSON parse failed")
+
+# Extraction and repair of the model's JSON reviewer
+_JSON_EXTRACT_RE = re.compile(r"\{.*\}", re.S)
+_STRAY_QUOTE_RE = re.compile(r"(\w)\"(\w)")
+_BAD_BSLASH_RE = re.compile(r"\\(?![\"\\/bfnrtu])")
+
+def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly", outline: bool = True) -> str:
+    """
+    Retrieve topic content from the Knowledge Base and generate a full reviewer outline
+    with expanded explanations per subtopic. Produces detailed, readable study material.
+    With outline=False only the KB grounding text is returned and no reviewer is generated.
+    """
+    cache_key = (query.lower().strip(), isPDF, mode, outline)
+    cached = outline_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    config = _load_config()
+    kb_id, kb_model_arn = _kb_settings()
 
     try:
         # --- Step 1: Retrieve base KB content ---
-        bedrock = boto3.client("bedrock-agent-runtime", region_name=config['aws_region'])
-        response = bedrock.retrieve_and_generate(
+        response = _bedrock_agent_client().retrieve_and_generate(
             input={"text": query},
             retrieveAndGenerateConfiguration={
                 "type": "KNOWLEDGE_BASE",
@@ -31,8 +74,16 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
         kb_text = response.get("output", {}).get("text", "").strip()
         kb_text = html.unescape(kb_text)
 
+        # An empty answer or a KB miss may be transient, so neither is cached
+        kb_found = bool(kb_text) and not KB_MISS_RE.search(kb_text)
+
+        # Callers that narrate the content themselves only need the KB grounding
+        if not outline:
+            if kb_found:
+                outline_cache.store(cache_key, kb_text)
+            return kb_text
+
         # --- Step 2: Generate the detailed reviewer content ---
-        bedrock_llm = boto3.client("bedrock-runtime", region_name=config['aws_region'])
         maxTokens = 8000 if isPDF == "true" else 1000
 
         prompt = f"""
@@ -79,7 +130,7 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
         Each section should have 3–5 sentences minimum.
         """
 
-        completion = bedrock_llm.invoke_model(
+        completion = _bedrock_runtime_client().invoke_model(
             modelId=config['bedrock']['model_id'],  # amazon.nova-pro-v1:0
             contentType="application/json",
             accept="application/json",
@@ -96,11 +147,12 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
         )
 
         # --- Step 3: Parse the output (Nova Pro format) ---
-        result = json.loads(completion["body"].read().decode("utf-8"))
+        # json.loads detects UTF-8 bytes itself, so the body is not decoded into a separate str first
+        result = json.loads(completion["body"].read())
         text_response = result["output"]["message"]["content"][0]["text"]
 
         # --- Step 4: Clean and safely parse JSON ---
-        match = re.search(r"\{.*\}", text_response, re.S)
+        match = _JSON_EXTRACT_RE.search(text_response)
         if not match:
             # print("⚠️ Model did not return valid JSON:", text_response)
             return kb_text
@@ -112,8 +164,8 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
             # print("⚠️ JSON decode failed, attempting auto-fix:", je)
             repaired = cleaned_json
             # Fix common issues
-            repaired = re.sub(r"(\w)\"(\w)", r"\1'\"\2", repaired)  # stray quotes
-            repaired = re.sub(r"\\(?![\"\\/bfnrtu])", r"\\\\", repaired)  # bad backslashes
+            repaired = _STRAY_QUOTE_RE.sub(r"\1'\"\2", repaired)  # stray quotes
+            repaired = _BAD_BSLASH_RE.sub(r"\\\\", repaired)  # bad backslashes
             try:
                 outline_data = json.loads(repaired)
             except Exception as inner_e:
@@ -121,33 +173,47 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
                 return f"{kb_text}\n\n⚠️ Reviewer JSON parse failed — raw output:\n{text_response}"
 
         # --- Step 5: Combine into final reviewer text ---
-        outline_section = "\n\n📘 Reviewer Lesson:\n"
+        parts = ["\n\n📘 Reviewer Lesson:\n"]
 
         if outline_data.get("Lesson Overview"):
-            outline_section += f"\nLesson Overview:\n{outline_data['Lesson Overview']}\n"
+            parts.append(f"\nLesson Overview:\n{outline_data['Lesson Overview']}\n")
 
         if outline_data.get("Learning Objectives"):
-            outline_section += "\nLearning Objectives:\n" + "\n".join(f"- {obj}" for obj in outline_data["Learning Objectives"])
+            parts.append("\nLearning Objectives:\n")
+            parts.append("\n".join(f"- {obj}" for obj in outline_data["Learning Objectives"]))
 
         if outline_data.get("Key Concepts and Explanations"):
-            outline_section += "\n\nKey Concepts and Explanations:\n"
-            for item in outline_data["Key Concepts and Explanations"]:
-                outline_section += f"\n🔹 {item['Subtopic']}:\n{item['Explanation']}\n"
+            parts.append("\n\nKey Concepts and Explanations:\n")
+            parts.extend(
+                f"\n🔹 {item['Subtopic']}:\n{item['Explanation']}\n"
+                for item in outline_data["Key Concepts and Explanations"]
+            )
 
         if outline_data.get("Application or Examples"):
-            outline_section += "\nApplication or Examples:\n" + "\n".join(f"- {ex}" for ex in outline_data["Application or Examples"])
+            parts.append("\nApplication or Examples:\n")
+            parts.append("\n".join(f"- {ex}" for ex in outline_data["Application or Examples"]))
 
         if outline_data.get("Memory Tips"):
-            outline_section += "\nMemory Tips:\n" + "\n".join(f"- {tip}" for tip in outline_data["Memory Tips"])
+            parts.append("\nMemory Tips:\n")
+            parts.append("\n".join(f"- {tip}" for tip in outline_data["Memory Tips"]))
 
         if outline_data.get("Quick Recap"):
-            outline_section += "\nQuick Recap:\n" + "\n".join(f"- {tip}" for tip in outline_data["Quick Recap"])
+            parts.append("\nQuick Recap:\n")
+            parts.append("\n".join(f"- {tip}" for tip in outline_data["Quick Recap"]))
+
+        outline_section = "".join(parts)
 
         # --- Step 6: Return final text ---
         if mode == "plain":
-            return f"{kb_text}\n\n{outline_section}".strip()
+            notes = f"{kb_text}\n\n{outline_section}".strip()
         else:
-            return f"Hey there! 😎 Let's go over your topic together!\n\n{kb_text}\n\n{outline_section}".strip()
+            notes = f"Hey there! 😎 Let's go over your topic together!\n\n{kb_text}\n\n{outline_section}".strip()
+
+        # Only fully parsed reviewers built on KB content are cached; fallbacks,
+        # misses and errors retry next call
+        if kb_found:
+            outline_cache.store(cache_key, notes)
+        return notes
 
     except Exception as e:
         # print("❌ Internal error in get_outline_and_notes:", str(e))
@@ -155,4 +221,8 @@ def get_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly
         return (
             "Hmm, something went wrong while generating your reviewer 😅 "
             "Please try again or check if the topic file was uploaded correctly."
-        )
\ No newline at end of file
+        )
+
+async def aget_outline_and_notes(query: str, isPDF: str = "true", mode: str = "friendly", outline: bool = True) -> str:
+    """get_outline_and_notes on a worker thread so the event loop keeps serving other work"""
+    return await asyncio.to_thread(get_outline_and_notes, query, isPDF, mode, outline)
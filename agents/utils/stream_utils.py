@@ -0,0 +1,182 @@
+import asyncio
+import re
+
+OPEN_TAG = "<thinking>"
+CLOSE_TAG = "</thinking>"
+
+
+def _partial_tag_pattern(tag: str) -> str:
+    """Pattern matching any proper prefix of tag at the end of the text"""
+    pattern = ""
+    for ch in reversed(tag[1:-1]):
+        pattern = f"(?:{re.escape(ch)}{pattern})?"
+    return re.escape(tag[0]) + pattern + r"\Z"
+
+
+# Tags are ASCII, so case-insensitivity is limited to ASCII letters
+_FLAGS = re.IGNORECASE | re.ASCII
+_OPEN_RE = re.compile(re.escape(OPEN_TAG), _FLAGS)
+_CLOSE_RE = re.compile(re.escape(CLOSE_TAG), _FLAGS)
+_PARTIAL_RES = {
+    OPEN_TAG: re.compile(_partial_tag_pattern(OPEN_TAG), _FLAGS),
+    CLOSE_TAG: re.compile(_partial_tag_pattern(CLOSE_TAG), _FLAGS),
+}
+
+# Items a background producer may read ahead of the consumer
+QUEUE_MAXSIZE = 64
+
+# Frame coalescing for transports that pay per message (e.g. WebSocket posts).
+# Frames ramp from MIN_FLUSH_CHARS up to FLUSH_CHARS, growing by GROWTH_FACTOR
+MIN_FLUSH_CHARS = 1
+FLUSH_CHARS = 512
+GROWTH_FACTOR = 3
+FLUSH_INTERVAL_MS = 20
+
+_END_OF_STREAM = object()
+
+
+def _partial_tag_length(text: str, start: int, tag: str) -> int:
+    """Length of the longest suffix of text[start:] that is a prefix of tag"""
+    # The leftmost match anchored at the end is the longest partial tag
+    match = _PARTIAL_RES[tag].search(text, max(start, len(text) - len(tag) + 1))
+    return len(text) - match.start() if match else 0
+
+
+class ThinkingTagStripper:
+    """
+    Incrementally removes <thinking>...</thinking> blocks from streamed text.
+
+    Only a tail shorter than the closing tag is carried between chunks, so each
+    chunk is scanned once regardless of how long the stream gets.
+    """
+
+    def __init__(self):
+        self._tail = ""
+        self.inside_thinking = False
+
+    def feed(self, data: str) -> str:
+        """Consume a chunk and return the text that is safe to emit"""
+        # Avoid copying the chunk when no partial tag is pending
+        text = self._tail + data if self._tail else data
+        visible = []
+        pos = 0
+
+        while True:
+            if not self.inside_thinking:
+                # Look for opening tag
+                match = _OPEN_RE.search(text, pos)
+                if match:
+                    visible.append(text[pos:match.start()])
+                    pos = match.end()
+                    self.inside_thinking = True
+                    continue
+
+                # Hold back a possible partial opening tag
+                keep = _partial_tag_length(text, pos, OPEN_TAG)
+                visible.append(text[pos:len(text) - keep])
+            else:
+                # Look for closing tag, discarding thinking content
+                match = _CLOSE_RE.search(text, pos)
+                if match:
+                    pos = match.end()
+                    self.inside_thinking = False
+                    continue
+
+                # Hold back a possible partial closing tag
+                keep = _partial_tag_length(text, pos, CLOSE_TAG)
+
+            self._tail = text[len(text) - keep:] if keep else ""
+            return "".join(visible)
+
+    def flush(self) -> str:
+        """Return any held-back text once the stream has ended"""
+        tail, self._tail = self._tail, ""
+        return "" if self.inside_thinking else tail
+
+
+async def strip_thinking(stream):
+    """Yield text from an agent event stream with thinking blocks removed"""
+    stripper = ThinkingTagStripper()
+
+    async for chunk in stream:
+        if "data" in chunk:
+            text = stripper.feed(chunk["data"])
+            if text:
+                yield text
+
+    # Flush remaining buffer (only if not inside thinking block)
+    remaining = stripper.flush()
+    if remaining:
+        yield remaining
+
+
+async def coalesced(
+    stream,
+    flush_chars: int = FLUSH_CHARS,
+    flush_interval_ms: float = FLUSH_INTERVAL_MS,
+    maxsize: int = QUEUE_MAXSIZE,
+    min_flush_chars: int = MIN_FLUSH_CHARS,
+    growth_factor: int = GROWTH_FACTOR,
+):
+    """
+    Join text fragments into progressively larger frames.
+
+    The first fragment is flushed immediately, so the first token reaches the
+    client without waiting. After every flush the frame threshold grows by
+    growth_factor, up to flush_chars. A pending frame is also flushed once flush_interval_ms has passed since its
+    first fragment, even while the stream is idle (e.g. during a tool call). The
+    stream is read on a single background task through a bounded queue, so slow
+    sends don't stall the model, and context variables set inside the stream stay
+    in one context. Errors raised by the stream are re-raised to the consumer.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+
+    async def produce():
+        try:
+            async for item in stream:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(_END_OF_STREAM)
+
+    loop = asyncio.get_running_loop()
+    interval = flush_interval_ms / 1000
+    threshold = min(min_flush_chars, flush_chars)
+    parts = []
+    size = 0
+    deadline = None
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            if deadline is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    yield "".join(parts)
+                    parts, size, deadline = [], 0, None
+                    threshold = min(threshold * growth_factor, flush_chars)
+                    continue
+
+            if item is _END_OF_STREAM:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            parts.append(item)
+            size += len(item)
+            if deadline is None:
+                deadline = loop.time() + interval
+            if size >= threshold or loop.time() >= deadline:
+                yield "".join(parts)
+                parts, size, deadline = [], 0, None
+                threshold = min(threshold * growth_factor, flush_chars)
+
+        if parts:
+            yield "".join(parts)
+    finally:
+        if not producer.done():
+            producer.cancel()
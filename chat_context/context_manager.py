@@ -1,32 +1,38 @@
 import boto3, os
-from boto3.dynamodb.conditions import Key
 
 BEDROCK_REGION = os.getenv("BEDROCK_REGION")
 AWS_ACCESS_KEY_ID = os.getenv("ACCESS_KEY")
 AWS_SECRET_ACCESS_KEY = os.getenv("SECRET_KEY")
 
+# Transcript prefix per stored role; anything other than "user" is the assistant
+ROLE_PREFIXES = {"user": "User: "}
+ASSISTANT_PREFIX = "Assistant: "
+
+# Module-scoped so warm containers reuse the connection pool across requests.
+# The low-level client skips the resource layer's type (de)serialization.
+dynamodb_client = boto3.client("dynamodb",
+    region_name=BEDROCK_REGION,
+    aws_access_key_id=AWS_ACCESS_KEY_ID,
+    aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+)
+
 def get_chat_context(session_id, limit=10):
-    dynamodb = boto3.resource("dynamodb",
-        region_name=BEDROCK_REGION,
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
-    table = dynamodb.Table(os.getenv("CHAT_TABLE"))
-    
-    response = table.query(
-        KeyConditionExpression=Key('PK').eq(session_id),
+    response = dynamodb_client.query(
+        TableName=os.getenv("CHAT_TABLE"),
+        KeyConditionExpression="PK = :pk",
+        ExpressionAttributeValues={":pk": {"S": session_id}},
         ScanIndexForward=False,
-        Limit=limit
+        Limit=limit,
+        # Only the fields rendered below; "role" is a reserved word
+        ProjectionExpression="#r, message",
+        ExpressionAttributeNames={"#r": "role"}
     )
     
-    context = ""
-    for item in reversed(response['Items']):
-        if(item['role'] == "user"):
-            context += f"User: {item['message']}\n"
-        else:
-            context += f"Assistant: {item['message']}\n"
-    
-    return context
+    # Newest-first query keeps the latest turns; reverse back to chronological order
+    return "".join([
+        f"{ROLE_PREFIXES.get(item['role']['S'], ASSISTANT_PREFIX)}{item['message']['S']}\n"
+        for item in reversed(response['Items'])
+    ])
 
 def build_message_with_context(session_id, current_message):
     chat_history = get_chat_context(session_id)
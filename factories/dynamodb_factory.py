@@ -1,49 +1,89 @@
 import boto3
+import time
 from typing import ClassVar
 
+# DynamoDB accepts at most 25 put requests per BatchWriteItem call
+BATCH_WRITE_SIZE = 25
+BATCH_WRITE_RETRIES = 5
+
+# (attribute, DynamoDB type, skip when empty) for fields written only when the model has them
+OPTIONAL_FIELDS = [
+    ('session_id', 'S', False),
+    ('file_name', 'S', True),
+    ('s3_file_name', 'S', True),
+    ('file_type', 'S', True),
+    ('title', 'S', False),
+    ('session_summary', 'S', True),
+    ('message_count', 'N', False),
+    ('is_deleted', 'BOOL', False),
+    ('has_ended', 'BOOL', False),
+    ('message_count_summarized', 'N', False),
+]
+
 def DynamodbFactory(model_cls):
     class _DynamodbFactory:
         DDB_CLIENT: ClassVar = None
         DDB_TABLE_NAME: ClassVar[str | None] = None
 
+        # Optional fields present on model_cls, resolved from the first object written
+        _FIELD_SPEC: ClassVar[list | None] = None
+
         @classmethod
-        def write(cls, table_name: str, object_data):
-            # Minimal DynamoDB write implementation
+        def _to_item(cls, object_data):
+            # Build the low-level DynamoDB item for a model object
+            spec = cls._FIELD_SPEC
+            if spec is None:
+                spec = [field for field in OPTIONAL_FIELDS if hasattr(object_data, field[0])]
+                cls._FIELD_SPEC = spec
+
+            session_id = getattr(object_data, 'session_id', None)
             item = {
-                'PK': {'S': object_data.session_id if hasattr(object_data, 'session_id') else object_data.user_id},
+                'PK': {'S': session_id if session_id is not None else object_data.user_id},
                 'SK': {'S': object_data.timestamp},
                 'user_id': {'S': object_data.user_id},
                 'message': {'S': getattr(object_data, 'message', '')},
                 'role': {'S': getattr(object_data, 'role', '')},
             }
-            
+
             # Add optional fields
-            if hasattr(object_data, 'session_id'):
-                item['session_id'] = {'S': object_data.session_id}
-            if hasattr(object_data, 'file_name') and object_data.file_name:
-                item['file_name'] = {'S': object_data.file_name}
-            if hasattr(object_data, 's3_file_name') and object_data.s3_file_name:
-                item['s3_file_name'] = {'S': object_data.s3_file_name}
-            if hasattr(object_data, 'file_type') and object_data.file_type:
-                item['file_type'] = {'S': object_data.file_type}
-            if hasattr(object_data, 'title'):
-                item['title'] = {'S': object_data.title}
-            if hasattr(object_data, 'session_summary') and object_data.session_summary:
-                item['session_summary'] = {'S': object_data.session_summary}
-            if hasattr(object_data, 'message_count'):
-                item['message_count'] = {'N': str(object_data.message_count)}
-            if hasattr(object_data, 'is_deleted'):
-                item['is_deleted'] = {'BOOL': object_data.is_deleted}
-            if hasattr(object_data, 'has_ended'):
-                item['has_ended'] = {'BOOL': object_data.has_ended}
-            if hasattr(object_data, 'message_count_summarized'):
-                item['message_count_summarized'] = {'N': str(object_data.message_count_summarized)}
-                
-            return cls.DDB_CLIENT.put_item(TableName=table_name, Item=item)
+            for attr, type_tag, skip_empty in spec:
+                value = getattr(object_data, attr)
+                if value is None or (skip_empty and not value):
+                    continue
+                item[attr] = {type_tag: str(value) if type_tag == 'N' else value}
+
+            return item
+
+        @classmethod
+        def write(cls, table_name: str, object_data):
+            # Minimal DynamoDB write implementation
+            return cls.DDB_CLIENT.put_item(TableName=table_name, Item=cls._to_item(object_data))
+
+        @classmethod
+        def write_many(cls, table_name: str, objects):
+            # Write objects in BatchWriteItem calls of up to 25 puts each,
+            # resending any unprocessed items with backoff
+            requests = [{'PutRequest': {'Item': cls._to_item(obj)}} for obj in objects]
+            unprocessed = []
+
+            for start in range(0, len(requests), BATCH_WRITE_SIZE):
+                pending = {table_name: requests[start:start + BATCH_WRITE_SIZE]}
+                for attempt in range(BATCH_WRITE_RETRIES + 1):
+                    response = cls.DDB_CLIENT.batch_write_item(RequestItems=pending)
+                    pending = response.get('UnprocessedItems') or {}
+                    if not pending:
+                        break
+                    if attempt < BATCH_WRITE_RETRIES:
+                        time.sleep(0.05 * (2 ** attempt))
+                unprocessed.extend(pending.get(table_name, []))
+
+            # Items DynamoDB still refused after every retry
+            return unprocessed
 
         @classmethod
         def query(cls, table_name: str, hash_key: str, range_key_condition=None, 
-                  filter_condition=None, scan_index_forward=True, limit=None, **kwargs):
+                  filter_condition=None, scan_index_forward=True, limit=None,
+                  projection_expression=None, expression_attribute_names=None, **kwargs):
             # Minimal DynamoDB query implementation
             key_condition = f"PK = :pk"
             expression_values = {':pk': {'S': hash_key}}
@@ -61,6 +101,11 @@ def DynamodbFactory(model_cls):
             
             if limit:
                 query_params['Limit'] = limit
+            # Fetch only the named attributes when the caller does not need whole items
+            if projection_expression:
+                query_params['ProjectionExpression'] = projection_expression
+            if expression_attribute_names:
+                query_params['ExpressionAttributeNames'] = expression_attribute_names
                 
             response = cls.DDB_CLIENT.query(**query_params)
             
@@ -1,43 +1,57 @@
 import os
 import json
-import boto3
 import asyncio
+import io
 import logging
+from json.encoder import encode_basestring_ascii
 from typing import Any, Dict
 
 # Agents (from first lambda)
 from agents import curriculum_agent, quizzer_agent, review_agent, general_agent
+from agents.utils.stream_utils import coalesced
 
 # Repositories, models, utils (from second lambda)
 from repositories.chat_repository import ChatRepository
 from repositories.user_session_repository import UserSessionRepository
 from models.file_model import File
-from utils.chat_utils import initialize_aws_clients, initialize_repository_tables
+from utils.chat_utils import initialize_aws_clients, initialize_repository_tables, get_websocket_client
 
 # Initialize AWS clients and repository tables (side-effects)
 initialize_aws_clients()
 initialize_repository_tables()
 
 logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 
 # Environment
 CONTEXT_WINDOW = int(os.getenv("CONTEXT_WINDOW", 8))
 
+# One event loop per execution environment; warm invocations reuse it and its
+# default thread pool instead of building both again as asyncio.run would
+_LOOP = asyncio.new_event_loop()
+asyncio.set_event_loop(_LOOP)
+
+AGENTS = {
+    "curriculum": curriculum_agent,
+    "quizzer": quizzer_agent,
+    "reviewer": review_agent,
+    "general": general_agent,
+}
+
 
 def get_agent(agent_name: str):
-    logger.info(f"Getting agent: {agent_name}")
-    if agent_name == "curriculum":
-        return curriculum_agent
-    elif agent_name == "quizzer":
-        return quizzer_agent
-    elif agent_name == "reviewer":
-        return review_agent
-    elif agent_name == "general":
-        return general_agent
-    else:
-        logger.error(f"Unknown agent requested: {agent_name}")
+    agent_module = AGENTS.get(agent_name)
+    if agent_module is None:
+        logger.error("Unknown agent requested: %s", agent_name)
         raise ValueError(f"Unknown agent: {agent_name}")
+    return agent_module
+
+
+async def _post_after(previous, apigw, connection_id: str, data: str):
+    """Post a frame on a worker thread once the previous post has completed"""
+    if previous is not None:
+        await previous
+    await asyncio.to_thread(apigw.post_to_connection, ConnectionId=connection_id, Data=data)
 
 
 async def stream_to_client_and_persist(
@@ -48,29 +62,39 @@ async def stream_to_client_and_persist(
     stage: str,
     session_id: str,
     user_id: str,
+    chat_object_user=None,
+    pending_post=None,
 ):
     """
     Stream model output chunks directly to WebSocket client AND persist final agent message
-    into ChatRepository. Returns the final assembled assistant text.
+    into ChatRepository. When chat_object_user is given it is written in the same
+    batch as the agent message. pending_post is an in-flight post (e.g. the chat
+    context) that the start frame must follow. Returns the final assembled assistant text.
     """
-    logger.info(f"Starting stream for user {user_id}, session {session_id}")
-    apigw = boto3.client(
-        "apigatewaymanagementapi",
-        endpoint_url=f"https://{domain}/{stage}"
-    )
+    logger.debug("Starting stream for user %s, session %s", user_id, session_id)
+    apigw = get_websocket_client(domain, stage)
 
-    assistant_chunks = []
+    assistant_buffer = io.StringIO()
     chunk_count = 0
     agent_response = ""
+    # Latest in-flight post; frames are chained so they reach the client in order
+    post_task = pending_post
+    # Every envelope shares session_id and user_input, so that part is encoded once
+    envelope_head = (
+        '{"session_id": ' + json.dumps(session_id)
+        + ', "user_input": ' + json.dumps(payload["user_input"])
+    )
+    in_progress_prefix = envelope_head + ', "type": "in_progress", "agent_response": '
     
     try:
-        logger.info("Beginning agent streaming")
-        # Mark start to client
-        apigw.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps({"session_id": session_id, "user_input": payload["user_input"], "agent_response": "", "type": "start_of_message"})
-        )
-        async for chunk in agent_module.stream_async(payload):
+        logger.debug("Beginning agent streaming")
+        # Mark start to client without holding up the agent's first turn
+        post_task = asyncio.create_task(_post_after(
+            post_task, apigw, connection_id,
+            envelope_head + ', "agent_response": "", "type": "start_of_message"}'
+        ))
+        # Small model deltas are merged into larger frames so each WebSocket post carries more text
+        async for chunk in coalesced(agent_module.stream_async(payload)):
             chunk_text = chunk
             # chunk_count += 1
             
@@ -125,47 +149,63 @@ async def stream_to_client_and_persist(
             # Send text chunks to WebSocket client
             if chunk_text and chunk_text.strip():
                 # logger.info(f"chunk text: {chunk_text}")
-                apigw.post_to_connection(
-                    ConnectionId=connection_id,
-                    Data=json.dumps({"session_id": session_id, "user_input": payload["user_input"], "agent_response": chunk_text, "type": "in_progress"})
-                )
+                # Surface a failed earlier post now instead of after the whole stream
+                if post_task is not None and post_task.done():
+                    post_task.result()
+                # Chunks are always str, so they go straight to json's C string encoder
+                post_task = asyncio.create_task(_post_after(
+                    post_task, apigw, connection_id,
+                    in_progress_prefix + encode_basestring_ascii(chunk_text) + "}"
+                ))
                 # chunk_text = json.loads(chunk_text)
                 # text_chunk = chunk_text['event']['contentBlockDelta']['delta']['text']
-                assistant_chunks.append(chunk_text)
+                assistant_buffer.write(chunk_text)
 
-        logger.info(f"Streaming completed. Total chunks: {chunk_count}")
+        logger.debug("Streaming completed. Total chunks: %d", chunk_count)
         
-        # Mark completion to client
-        apigw.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps({"session_id": session_id, "user_input": payload["user_input"], "agent_response": "", "type": "end_of_message"})
+        # Mark completion to client after every in-progress frame has been posted
+        await _post_after(
+            post_task, apigw, connection_id,
+            envelope_head + ', "agent_response": "", "type": "end_of_message"}'
         )
+        post_task = None
 
         # Use parsed agent_response or fallback to concatenated chunks
         if not agent_response:
-            agent_response = "".join(assistant_chunks)
+            agent_response = assistant_buffer.getvalue()
         
-        logger.info(f"Agent response length: {len(agent_response)} characters")
+        logger.debug("Agent response length: %d characters", len(agent_response))
 
-        # Persist agent message
-        logger.info(f"Persisting agent response to database. Response: {agent_response}")
+        # Persist user and agent messages in one BatchWriteItem round trip
+        logger.info("Persisting agent response to database (len=%d)", len(agent_response))
         chat_object_agent = ChatRepository.initialize_chat_agent(
             user_id=user_id,
             agent_response=agent_response,
             session_id=session_id
         )
-        ChatRepository.save(chat_object=chat_object_agent)
-        logger.info("Agent response saved successfully")
+        chat_objects = [chat_object_agent] if chat_object_user is None else [chat_object_user, chat_object_agent]
+        await asyncio.to_thread(ChatRepository.save_many, chat_objects)
+        chat_object_user = None
+        logger.debug("Agent response saved successfully")
 
         return agent_response
 
     except Exception as stream_exc:
-        logger.exception(f"Error during streaming: {str(stream_exc)}")
-        # Attempt to notify client of streaming error
+        logger.exception("Error during streaming: %s", stream_exc)
+        # Let any in-flight post settle so the error frame arrives last
+        if post_task is not None:
+            await asyncio.gather(post_task, return_exceptions=True)
+        # Keep the user message when the stream or the batch write failed before storing it
+        if chat_object_user is not None:
+            try:
+                await asyncio.to_thread(ChatRepository.save, chat_object=chat_object_user)
+            except Exception:
+                logger.exception("Failed to persist user message after streaming error")
+        # Attempt to notify client of streaming error; the chain has drained, so nothing precedes it
         try:
-            apigw.post_to_connection(
-                ConnectionId=connection_id,
-                Data=json.dumps({"type": "error", "error": str(stream_exc)})
+            await _post_after(
+                None, apigw, connection_id,
+                json.dumps({"type": "error", "error": str(stream_exc)})
             )
         except Exception:
             logger.exception("Failed to post streaming error to client")
@@ -178,22 +218,22 @@ async def async_handler(event, context):
     Async entrypoint: handles WebSocket event, session handling, saves user message,
     compiles context and streams agent output to client while persisting it.
     """
-    logger.info(f"Lambda invoked with event keys: {list(event.keys())}")
-    logger.info(f"Request context: {event.get('requestContext', {})}")
+    logger.debug("Lambda invoked with event keys: %s", list(event))
+    logger.debug("Request context: %s", event.get("requestContext", {}))
     
     try:
         body = json.loads(event.get("body", "{}"))
-        logger.info(f"Parsed body keys: {list(body.keys())}")
+        logger.debug("Parsed body keys: %s", list(body))
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON in request body: {e}")
-        logger.error(f"Raw body: {event.get('body', 'None')}")
+        logger.error("Invalid JSON in request body: %s", e)
+        logger.error("Raw body: %s", event.get("body", "None"))
         return {"statusCode": 400, "body": json.dumps({"error": "Invalid JSON format"})}
     
     domain = event["requestContext"].get("domainName")
     stage = event["requestContext"].get("stage")
     connection_id = event["requestContext"].get("connectionId")
     
-    logger.info(f"WebSocket context - domain: {domain}, stage: {stage}, connection_id: {connection_id}")
+    logger.debug("WebSocket context - domain: %s, stage: %s, connection_id: %s", domain, stage, connection_id)
 
     if not connection_id or not domain or not stage:
         logger.error("Missing WebSocket requestContext fields")
@@ -205,11 +245,11 @@ async def async_handler(event, context):
     session_id = body.get("session_id")
     file_input = None
     
-    logger.info(f"Request params - agent: {agent_name}, user_id: {user_id}, session_id: {session_id}")
-    logger.info(f"User input length: {len(user_input) if user_input else 0}")
+    logger.debug("Request params - agent: %s, user_id: %s, session_id: %s", agent_name, user_id, session_id)
+    logger.debug("User input length: %d", len(user_input) if user_input else 0)
 
     if not user_id or not user_input:
-        logger.error(f"Missing required fields - user_id: {bool(user_id)}, user_input: {bool(user_input)}")
+        logger.error("Missing required fields - user_id: %s, user_input: %s", bool(user_id), bool(user_input))
         ChatRepository.push_to_client(
             connection_id=connection_id,
             response={"error": "Missing user_id or user_input", "connectionId": connection_id}
@@ -217,7 +257,7 @@ async def async_handler(event, context):
         return {"statusCode": 400, "body": json.dumps({"error": "Missing user_id or user_input"})}
 
     # Send initial processing acknowledgment
-    logger.info("Sending processing acknowledgment to client")
+    logger.debug("Sending processing acknowledgment to client")
     ChatRepository.push_to_client(
         connection_id=connection_id,
         response={"message": "processing", "connectionId": connection_id}
@@ -225,7 +265,7 @@ async def async_handler(event, context):
 
     # Handle file input if present
     if body.get("file_input"):
-        logger.info("Processing file input")
+        logger.debug("Processing file input")
         file_data = body["file_input"]
         file_input = File(
             file_name=file_data.get("file_name"),
@@ -233,40 +273,43 @@ async def async_handler(event, context):
             s3_file_name=file_data.get("s3_file_name"),
             file_size=file_data.get("file_size")
         )
-        logger.info(f"File input created: {file_data.get('file_name')}")
+        logger.debug("File input created: %s", file_data.get("file_name"))
 
     # Session handling
-    logger.info("Starting session handling")
+    logger.debug("Starting session handling")
+    is_existing_session = bool(session_id)
     try:
         if session_id:
-            logger.info(f"Looking up existing session: {session_id}")
+            logger.debug("Looking up existing session: %s", session_id)
             user_session = UserSessionRepository.get_user_session(user_id=user_id, session_id=session_id)
             if not user_session:
-                logger.error(f"Session not found: {session_id}")
+                logger.error("Session not found: %s", session_id)
                 ChatRepository.push_to_client(
                     connection_id=connection_id,
                     response={"error": "Session not found", "connectionId": connection_id}
                 )
                 return {"statusCode": 404, "body": json.dumps({"error": "Session not found"})}
-            logger.info(f"Found existing session with {user_session.message_count} messages")
+            logger.debug("Found existing session with %s messages", user_session.message_count)
         else:
-            logger.info("Creating new session")
+            logger.debug("Creating new session")
             session_id = UserSessionRepository.construct_session_id(user_id=user_id)
+            # The new row already counts the message being sent, so no increment follows
             user_session = UserSessionRepository.initialize_user_session(
-                user_id=user_id, title="New Chat", session_id=session_id, summary=""
+                user_id=user_id, title="New Chat", session_id=session_id, summary="", message_count=1
             )
             UserSessionRepository.save(session_object=user_session)
-            logger.info(f"New session created: {session_id}")
+            logger.info("New session created: %s", session_id)
     except Exception as sess_exc:
-        logger.exception(f"Error handling user session: {str(sess_exc)}")
+        logger.exception("Error handling user session: %s", sess_exc)
         ChatRepository.push_to_client(
             connection_id=connection_id,
             response={"error": str(sess_exc), "connectionId": connection_id}
         )
         return {"statusCode": 500, "body": json.dumps({"error": str(sess_exc)})}
 
-    # Save user message
-    logger.info("Saving user message")
+    # Count the message and load history concurrently. The user message itself is
+    # written together with the agent reply once streaming ends.
+    logger.debug("Updating message count and compiling chat history")
     try:
         chat_object_user = ChatRepository.initialize_chat_user(
             user_input=user_input,
@@ -274,52 +317,40 @@ async def async_handler(event, context):
             user_id=user_id,
             file_input=file_input
         )
-        ChatRepository.save(chat_object=chat_object_user)
-        logger.info("User message saved successfully")
-
-        user_session.message_count = (user_session.message_count or 0) + 1
-        UserSessionRepository.save(session_object=user_session)
-        logger.info(f"Updated session message count to: {user_session.message_count}")
+        if is_existing_session:
+            _, recent_messages = await asyncio.gather(
+                asyncio.to_thread(UserSessionRepository.increment_message_count, user_session, 1),
+                asyncio.to_thread(
+                    ChatRepository.compile_chat_history,
+                    session_id=session_id,
+                    message_count=user_session.message_count,
+                    context_window=CONTEXT_WINDOW,
+                    latest_message=chat_object_user
+                ),
+            )
+        else:
+            # A new session has no stored history, so there is nothing to query
+            recent_messages = [{"role": chat_object_user.role, "content": [{"text": chat_object_user.message}]}]
+        logger.debug("Session message count is now %s", user_session.message_count)
     except Exception as save_exc:
-        logger.exception(f"Error saving user chat: {str(save_exc)}")
+        logger.exception("Error updating session or compiling history: %s", save_exc)
         ChatRepository.push_to_client(
             connection_id=connection_id,
             response={"error": str(save_exc), "connectionId": connection_id}
         )
         return {"statusCode": 500, "body": json.dumps({"error": str(save_exc)})}
 
-    # Compile chat history
-    logger.info("Compiling chat history")
-    try:
-        if body.get("session_id"):
-            logger.info(f"Compiling history for existing session with context window: {CONTEXT_WINDOW}")
-            recent_messages = ChatRepository.compile_chat_history(
-                session_id=session_id,
-                message_count=user_session.message_count,
-                context_window=CONTEXT_WINDOW
-            )
-            summary = ChatRepository.format_session_summary(current_summary=user_session.session_summary)
-            chat_messages = summary + recent_messages
-            logger.info(f"Compiled {len(recent_messages)} recent messages with summary")
-        else:
-            logger.info("Compiling history for new session")
-            chat_messages = ChatRepository.compile_chat_history(
-                session_id=session_id,
-                message_count=user_session.message_count,
-                context_window=CONTEXT_WINDOW
-            )
-            logger.info(f"Compiled {len(chat_messages)} messages for new session")
-    except Exception as compile_exc:
-        logger.exception(f"Error compiling chat history: {str(compile_exc)}")
-        ChatRepository.push_to_client(
-            connection_id=connection_id,
-            response={"error": str(compile_exc), "connectionId": connection_id}
-        )
-        return {"statusCode": 500, "body": json.dumps({"error": str(compile_exc)})}
+    # Only an existing session can carry a summary worth prepending
+    if is_existing_session:
+        chat_messages = ChatRepository.format_session_summary(current_summary=user_session.session_summary) + recent_messages
+    else:
+        chat_messages = recent_messages
+    logger.debug("Compiled %d recent messages", len(recent_messages))
 
-    # Send chat context to client
-    logger.info("Sending chat context to client")
-    ChatRepository.push_to_client(
+    # Send chat context to client on a worker thread; streaming starts without waiting for it
+    logger.debug("Sending chat context to client")
+    context_push = asyncio.create_task(asyncio.to_thread(
+        ChatRepository.push_to_client,
         connection_id=connection_id,
         response={
             "session_id": session_id,
@@ -328,10 +359,10 @@ async def async_handler(event, context):
             "has_file_attachment": file_input is not None,
             "connectionId": connection_id
         }
-    )
+    ))
 
     # Prepare payload for agent: full chat context + latest user input
-    logger.info("Preparing agent payload")
+    logger.debug("Preparing agent payload")
     agent_payload = {
         "chat_messages": chat_messages,
         "user_input": user_input,
@@ -340,15 +371,18 @@ async def async_handler(event, context):
         "file_input": file_input,
         **{k: v for k, v in body.get("payload", {}).items()}
     }
-    logger.info(f"Agent payload prepared with {len(chat_messages)} messages")
+    logger.debug("Agent payload prepared with %d messages", len(chat_messages))
 
     # Forward to agent and stream results
-    logger.info(f"Getting agent module: {agent_name}")
+    logger.debug("Getting agent module: %s", agent_name)
     try:
         agent_module = get_agent(agent_name)
-        logger.info(f"Agent module retrieved successfully: {agent_module}")
+        logger.debug("Agent module retrieved successfully: %s", agent_module)
     except ValueError as e:
-        logger.error(f"Invalid agent name: {agent_name}")
+        logger.error("Invalid agent name: %s", agent_name)
+        # The write runs on a worker thread while the context push is still in flight
+        await asyncio.to_thread(ChatRepository.save_many, [chat_object_user])
+        await context_push
         ChatRepository.push_to_client(
             connection_id=connection_id,
             response={"error": str(e), "connectionId": connection_id}
@@ -356,7 +390,9 @@ async def async_handler(event, context):
         return {"statusCode": 400, "body": json.dumps({"error": str(e)})}
 
     try:
-        logger.info("Starting agent streaming process")
+        logger.debug("Starting agent streaming process")
+        # KB cache entries are shared only within this session; the stream's tasks inherit it
+        curriculum_agent.kb_cache_scope.set(session_id)
         await stream_to_client_and_persist(
             agent_module=agent_module,
             payload=agent_payload,
@@ -364,12 +400,15 @@ async def async_handler(event, context):
             domain=domain,
             stage=stage,
             session_id=session_id,
-            user_id=user_id
+            user_id=user_id,
+            chat_object_user=chat_object_user,
+            pending_post=context_push
         )
-        logger.info("Lambda execution completed successfully")
+        logger.debug("Lambda execution completed successfully")
         return {"statusCode": 200, "body": json.dumps({"message": "OK"})}
     except Exception as e:
-        logger.exception(f"Error while streaming from agent: {str(e)}")
+        logger.exception("Error while streaming from agent: %s", e)
+        await asyncio.gather(context_push, return_exceptions=True)
         ChatRepository.push_to_client(
             connection_id=connection_id,
             response={"error": str(e), "connectionId": connection_id}
@@ -377,13 +416,25 @@ async def async_handler(event, context):
         return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
 
 
+def _run(coro):
+    """Run coro on the shared loop, then cancel any tasks it left behind"""
+    try:
+        return _LOOP.run_until_complete(coro)
+    finally:
+        pending = asyncio.all_tasks(_LOOP)
+        for task in pending:
+            task.cancel()
+        if pending:
+            _LOOP.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+
+
 def lambda_handler(event, context):
     """Lambda synchronous entrypoint."""
-    logger.info("Lambda handler started")
+    logger.debug("Lambda handler started")
     try:
-        result = asyncio.run(async_handler(event, context))
-        logger.info(f"Lambda handler completed with status: {result.get('statusCode')}")
+        result = _run(async_handler(event, context))
+        logger.info("Lambda handler completed with status: %s", result.get("statusCode"))
         return result
     except Exception as e:
-        logger.exception(f"Fatal error in lambda handler: {str(e)}")
+        logger.exception("Fatal error in lambda handler: %s", e)
         return {"statusCode": 500, "body": json.dumps({"error": str(e)})}
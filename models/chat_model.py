@@ -2,14 +2,33 @@ from typing import ClassVar, Optional
 
 class Chat:
     REPOSITORY: ClassVar
-    
-    def __init__(self, **data):
-        self.session_id = data['session_id']
-        self.timestamp = data['timestamp']
-        self.role = data['role']
-        self.message = data.get('message', '')
-        self.user_id = data['user_id']
-        self.file_name = data.get('file_name')
-        self.s3_file_name = data.get('s3_file_name')
-        self.file_type = data.get('file_type')
-        self.topic = data.get('topic')
+
+    # REPOSITORY is assigned on the class, so it is not a slot
+    __slots__ = (
+        'session_id', 'timestamp', 'role', 'message', 'user_id',
+        'file_name', 's3_file_name', 'file_type', 'topic',
+    )
+
+    def __init__(
+        self,
+        session_id: str,
+        timestamp: str,
+        role: str,
+        user_id: str,
+        message: str = '',
+        file_name: Optional[str] = None,
+        s3_file_name: Optional[str] = None,
+        file_type: Optional[str] = None,
+        topic: Optional[str] = None,
+        **_,
+    ):
+        # Other stored attributes (e.g. PK, SK) are ignored
+        self.session_id = session_id
+        self.timestamp = timestamp
+        self.role = role
+        self.message = message
+        self.user_id = user_id
+        self.file_name = file_name
+        self.s3_file_name = s3_file_name
+        self.file_type = file_type
+        self.topic = topic
@@ -2,14 +2,33 @@ from typing import ClassVar
 
 class UserSession:
     REPOSITORY: ClassVar
-    
-    def __init__(self, **data):
-        self.user_id = data['user_id']
-        self.timestamp = data['timestamp']
-        self.session_id = data['session_id']
-        self.title = data['title']
-        self.session_summary = data.get('session_summary', '')
-        self.is_deleted = data.get('is_deleted', False)
-        self.has_ended = data.get('has_ended', False)
-        self.message_count = data.get('message_count', 0)
-        self.message_count_summarized = data.get('message_count_summarized', 0)
+
+    # REPOSITORY is assigned on the class, so it is not a slot
+    __slots__ = (
+        'user_id', 'timestamp', 'session_id', 'title', 'session_summary',
+        'is_deleted', 'has_ended', 'message_count', 'message_count_summarized',
+    )
+
+    def __init__(
+        self,
+        user_id: str,
+        timestamp: str,
+        session_id: str,
+        title: str,
+        session_summary: str = '',
+        is_deleted: bool = False,
+        has_ended: bool = False,
+        message_count: int = 0,
+        message_count_summarized: int = 0,
+        **_,
+    ):
+        # Other stored attributes (e.g. PK, SK, role, message) are ignored
+        self.user_id = user_id
+        self.timestamp = timestamp
+        self.session_id = session_id
+        self.title = title
+        self.session_summary = session_summary
+        self.is_deleted = is_deleted
+        self.has_ended = has_ended
+        self.message_count = message_count
+        self.message_count_summarized = message_count_summarized
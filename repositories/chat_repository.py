@@ -1,11 +1,13 @@
-import os
 import json
-from datetime import datetime
 from typing import ClassVar, Optional
-from zoneinfo import ZoneInfo
 
 from factories.dynamodb_factory import DynamodbFactory
 from models.chat_model import Chat
+from utils.time_utils import chat_timestamp
+
+# Attributes compile_chat_history needs to build Chat objects; file metadata is skipped
+_HISTORY_PROJECTION = "PK, SK, session_id, user_id, #r, message"
+_HISTORY_ATTRIBUTE_NAMES = {"#r": "role"}
 
 class ChatRepository(DynamodbFactory(Chat)):
     DDB_TABLE_NAME: ClassVar[str | None] = None
@@ -47,9 +49,7 @@ class ChatRepository(DynamodbFactory(Chat)):
         data = {
             "user_id": user_id,
             "session_id": session_id,
-            "timestamp": datetime.now(
-                ZoneInfo(os.getenv("TZ", "Asia/Manila").lstrip(":"))
-            ).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "timestamp": chat_timestamp(),
             "role": "user",
             "message": user_input,
             "file_name": file_name,
@@ -68,9 +68,7 @@ class ChatRepository(DynamodbFactory(Chat)):
         data = {
             "user_id": user_id,
             "session_id": session_id,
-            "timestamp": datetime.now(
-                ZoneInfo(os.getenv("TZ", "Asia/Manila").lstrip(":"))
-            ).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "timestamp": chat_timestamp(),
             "role": "assistant",
             "message": agent_response,
         }
@@ -85,25 +83,29 @@ class ChatRepository(DynamodbFactory(Chat)):
         message_count: int | None = None,
         context_window: int = 8,
         model_id: str | None = None,
+        latest_message: Chat | None = None,
     ):
 
+        # latest_message is not stored yet (it is written with the reply), so it
+        # takes one slot of the window and is put at the head
+        limit = context_window * 2 - 1 if latest_message is not None else context_window * 2
         chat_messages, _ = cls.query(
             table_name=cls.DDB_TABLE_NAME,
             hash_key=session_id,
             range_key_condition=None,
             scan_index_forward=False,
-            limit=context_window * 2,
+            limit=limit,
+            projection_expression=_HISTORY_PROJECTION,
+            expression_attribute_names=_HISTORY_ATTRIBUTE_NAMES,
         )
 
-        messages = []
-        for old_message in reversed(chat_messages):
-            content = [{"text": old_message.message}]
-            messages.append({
-                "role": old_message.role,
-                "content": content,
-            })
+        if latest_message is not None:
+            chat_messages.insert(0, latest_message)
 
-        return messages
+        return [
+            {"role": m.role, "content": [{"text": m.message}]}
+            for m in chat_messages[::-1]
+        ]
 
     @classmethod
     def format_session_summary(cls, current_summary):
@@ -123,3 +125,17 @@ class ChatRepository(DynamodbFactory(Chat)):
             table_name=cls.DDB_TABLE_NAME, 
             object_data=chat_object
         )
+
+    @classmethod
+    def save_many(cls, chat_objects: list[Chat]):
+        unprocessed = cls.write_many(
+            table_name=cls.DDB_TABLE_NAME,
+            objects=chat_objects
+        )
+        # Rows BatchWriteItem still refused after its retries get one plain put each,
+        # so every message is either stored or reported by an exception
+        for request in unprocessed:
+            cls.DDB_CLIENT.put_item(
+                TableName=cls.DDB_TABLE_NAME,
+                Item=request['PutRequest']['Item']
+            )
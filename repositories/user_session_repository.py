@@ -1,12 +1,9 @@
-import os
-import random
-import string
-from datetime import datetime
+import secrets
 from typing import ClassVar
-from zoneinfo import ZoneInfo
 
 from factories.dynamodb_factory import DynamodbFactory
 from models.user_session_model import UserSession
+from utils.time_utils import session_timestamp
 
 class UserSessionRepository(DynamodbFactory(UserSession)):
     DDB_TABLE_NAME: ClassVar[str | None] = None
@@ -15,25 +12,24 @@ class UserSessionRepository(DynamodbFactory(UserSession)):
 
     @staticmethod
     def construct_session_id(user_id: str):
-        random_part = "".join(random.choices(string.ascii_letters + string.digits, k=8))
+        # 6 random bytes encode to 8 URL-safe characters
+        random_part = secrets.token_urlsafe(6)
         session_id = f"{user_id}-{random_part}"
         return session_id
 
     @classmethod
     def initialize_user_session(
-        cls, user_id: str, session_id: str, summary: str, title: str
+        cls, user_id: str, session_id: str, summary: str, title: str, message_count: int = 0
     ):
         data = {
             "user_id": user_id,
             "session_id": session_id,
-            "timestamp": datetime.now(
-                ZoneInfo(os.getenv("TZ", "Asia/Manila").lstrip(":"))
-            ).strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": session_timestamp(),
             "title": title,
             "session_summary": summary,
             "is_deleted": False,
             "has_ended": False,
-            "message_count": 0,
+            "message_count": message_count,
             "message_count_summarized": 0,
         }
         UserSession.REPOSITORY = cls
@@ -49,6 +45,22 @@ class UserSessionRepository(DynamodbFactory(UserSession)):
         )
         return session_details[0] if session_details else None
 
+    @classmethod
+    def increment_message_count(cls, session_object: UserSession, increment: int = 1):
+        """Atomically add to the stored message_count without rewriting the session item"""
+        response = cls.DDB_CLIENT.update_item(
+            TableName=cls.DDB_TABLE_NAME,
+            Key={
+                'PK': {'S': session_object.session_id},
+                'SK': {'S': session_object.timestamp},
+            },
+            UpdateExpression="ADD message_count :incr",
+            ExpressionAttributeValues={':incr': {'N': str(increment)}},
+            ReturnValues="UPDATED_NEW"
+        )
+        session_object.message_count = int(response['Attributes']['message_count']['N'])
+        return response
+
     @classmethod
     def save(cls, session_object: UserSession):
         return cls.write(
@@ -1,5 +1,6 @@
 import os
 import boto3
+from functools import lru_cache
 from botocore.config import Config
 
 from repositories.chat_repository import ChatRepository
@@ -13,8 +14,19 @@ def initialize_aws_clients(region=None):
         retries={"max_attempts": int(os.getenv("BEDROCK_MAX_ATTEMPTS", 2)), "mode": "standard"},
     )
     
-    ChatRepository.DDB_CLIENT = boto3.client("dynamodb", region_name=region)
-    UserSessionRepository.DDB_CLIENT = boto3.client("dynamodb", region_name=region)
+    # Keep-alive lets warm invocations reuse open TLS connections. Both repositories
+    # share one client so they also share its connection pool.
+    ddb_client = boto3.client("dynamodb", region_name=region, config=Config(tcp_keepalive=True))
+    ChatRepository.DDB_CLIENT = ddb_client
+    UserSessionRepository.DDB_CLIENT = ddb_client
+
+    # Open the DynamoDB connection during cold start so the first request skips the
+    # TLS handshake. Only inside Lambda, where the network is always available.
+    if os.getenv("AWS_LAMBDA_FUNCTION_NAME"):
+        try:
+            ddb_client.describe_limits()
+        except Exception:
+            pass
     
     # WebSocket client for real-time communication
     api_id = os.getenv("WEBSOCKET_API_ID")
@@ -25,6 +37,15 @@ def initialize_aws_clients(region=None):
             endpoint_url=f"https://{api_id}.execute-api.{region}.amazonaws.com/{stage}"
         )
 
+@lru_cache(maxsize=8)
+def get_websocket_client(domain: str, stage: str):
+    """API Gateway management client for a WebSocket endpoint, reused across warm invocations"""
+    return boto3.client(
+        'apigatewaymanagementapi',
+        endpoint_url=f"https://{domain}/{stage}",
+        config=Config(tcp_keepalive=True)
+    )
+
 def initialize_repository_tables():
     ChatRepository.DDB_TABLE_NAME = os.getenv("CHAT_TABLE", None)
     UserSessionRepository.DDB_TABLE_NAME = os.getenv("CHAT_TABLE", None)
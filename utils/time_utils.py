@@ -0,0 +1,20 @@
+import os
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+# Resolved once per process; TZ may carry the POSIX ":" prefix
+TZ_NAME = os.getenv("TZ", "Asia/Manila").lstrip(":")
+TZ = ZoneInfo(TZ_NAME)
+
+TS_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+SESSION_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def chat_timestamp() -> str:
+    """Current local time with millisecond precision, used as the chat sort key"""
+    return datetime.now(TZ).strftime(TS_FORMAT)[:-3]
+
+
+def session_timestamp() -> str:
+    """Current local time with second precision, used as the session sort key"""
+    return datetime.now(TZ).strftime(SESSION_TS_FORMAT)